@@ -0,0 +1,296 @@
+import os
+import sys
+import stat
+import time
+import shutil
+
+from distutils import log
+from distutils.errors import DistutilsOptionError
+
+from utils import hash_file
+from utils import read_json_file
+from utils import write_json_file
+
+# Default size limit of the local store
+DEFAULT_MAX_SIZE = 5 * 1024 * 1024 * 1024
+
+# Objects without an artifact are only removed when they are older than
+# this, a concurrent build may not have written its manifest yet
+ORPHAN_AGE = 3600
+
+SIZE_UNITS = {
+    "": 1,
+    "K": 1024,
+    "M": 1024 * 1024,
+    "G": 1024 * 1024 * 1024,
+    "T": 1024 * 1024 * 1024 * 1024,
+}
+
+
+def parse_size(value):
+    """Parse a size like "500M" or "5G" into bytes"""
+    number = value.strip().upper()
+    unit = ""
+    if number and number[-1] in SIZE_UNITS:
+        number, unit = number[:-1], number[-1]
+    try:
+        size = int(float(number) * SIZE_UNITS[unit])
+    except ValueError:
+        size = -1
+    if size <= 0:
+        raise DistutilsOptionError("Invalid cache size %s, expected a number "
+            "of bytes with an optional K, M, G or T suffix" % value)
+    return size
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class ArtifactBackend(object):
+    """Stores build artifacts by key
+
+    An artifact is a set of named directory trees, e.g. {"install": path,
+    "doc": path}. Backends implement contains(), fetch() and store(); a
+    backend that can't (or won't) keep an artifact simply reports a miss
+    the next time it is asked for it.
+    """
+    def contains(self, key):
+        raise NotImplementedError
+
+    def fetch(self, key, dirs):
+        """Restore the artifact into the given directories, replacing their
+        content. Returns False when the artifact is not available."""
+        raise NotImplementedError
+
+    def store(self, key, dirs):
+        """Store the content of the given directories under key"""
+        raise NotImplementedError
+
+    def trim(self):
+        """Evict artifacts until the store is within its size limit"""
+        pass
+
+
+class LocalArtifactStore(ArtifactBackend):
+    """Content-addressed artifact store in a local (or shared) directory
+
+    The files are kept once per content under objects/<sha1>, and every
+    artifact is a json manifest under entries/<key>.json listing the files,
+    symlinks and empty directories of its trees. Restoring hardlinks the
+    objects into place, or copies them when hardlinks are not possible.
+    Everything is written under private names first and renamed, so
+    several builds can share the store. The least recently used artifacts
+    are evicted when the objects take more than max_size bytes.
+    """
+    def __init__(self, root, max_size=DEFAULT_MAX_SIZE):
+        self.root = os.path.abspath(root)
+        self.max_size = max_size
+        self.objects_dir = os.path.join(self.root, "objects")
+        self.entries_dir = os.path.join(self.root, "entries")
+
+    def get_entry_path(self, key):
+        return os.path.join(self.entries_dir, key + ".json")
+
+    def get_object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest[2:])
+
+    def read_entry(self, key):
+        return read_json_file(self.get_entry_path(key))
+
+    def contains(self, key):
+        return os.path.exists(self.get_entry_path(key))
+
+    def fetch(self, key, dirs):
+        entry = self.read_entry(key)
+        if entry is None or sorted(entry["dirs"].keys()) != sorted(dirs.keys()):
+            return False
+        # An object may have been evicted by a concurrent build
+        for items in entry["dirs"].values():
+            for relpath, kind, value, mode in items:
+                if kind == "f" and not os.path.exists(self.get_object_path(value)):
+                    log.warn("Artifact %s is incomplete, ignoring it" % key)
+                    return False
+        linked = copied = 0
+        for name, items in entry["dirs"].items():
+            dest_dir = dirs[name]
+            if os.path.lexists(dest_dir):
+                shutil.rmtree(dest_dir)
+            os.makedirs(dest_dir)
+            for relpath, kind, value, mode in items:
+                path = os.path.join(dest_dir, *relpath.split("/"))
+                parent = os.path.dirname(path)
+                if not os.path.isdir(parent):
+                    os.makedirs(parent)
+                if kind == "d":
+                    if not os.path.isdir(path):
+                        os.makedirs(path)
+                elif kind == "l":
+                    os.symlink(value, path)
+                elif self._link_object(value, mode, path):
+                    linked += 1
+                else:
+                    copied += 1
+        # Mark the artifact as recently used
+        try:
+            os.utime(self.get_entry_path(key), None)
+        except OSError:
+            pass
+        log.info("Restored artifact %s (%d files linked, %d copied)" %
+            (key, linked, copied))
+        return True
+
+    def _link_object(self, digest, mode, path):
+        object_path = self.get_object_path(digest)
+        # The object was stored with the mode of its first file, files
+        # with the same content and another mode need their own copy
+        if stat.S_IMODE(os.stat(object_path).st_mode) == mode:
+            try:
+                os.link(object_path, path)
+                return True
+            except (OSError, AttributeError):
+                # Another filesystem, or no hardlinks on this platform
+                pass
+        shutil.copyfile(object_path, path)
+        os.chmod(path, mode)
+        return False
+
+    def store(self, key, dirs):
+        manifest = {}
+        added = 0
+        for name, src_dir in dirs.items():
+            items = []
+            for root, dirnames, filenames in os.walk(src_dir):
+                dirnames.sort()
+                reldir = os.path.relpath(root, src_dir).replace(os.sep, "/")
+                prefix = reldir != "." and reldir + "/" or ""
+                if reldir != "." and not dirnames and not filenames:
+                    items.append([reldir, "d", None, None])
+                for dirname in list(dirnames):
+                    path = os.path.join(root, dirname)
+                    if os.path.islink(path):
+                        # os.walk doesn't follow them, keep them as links
+                        items.append([prefix + dirname, "l", os.readlink(path), None])
+                        dirnames.remove(dirname)
+                for filename in sorted(filenames):
+                    path = os.path.join(root, filename)
+                    if os.path.islink(path):
+                        items.append([prefix + filename, "l", os.readlink(path), None])
+                        continue
+                    digest, is_new = self._add_object(path)
+                    added += is_new
+                    items.append([prefix + filename, "f", digest,
+                        stat.S_IMODE(os.stat(path).st_mode)])
+            manifest[name] = items
+        entry = {
+            "key": key,
+            "created": time.time(),
+            "dirs": manifest,
+        }
+        write_json_file(self.get_entry_path(key), entry)
+        log.info("Stored artifact %s (%d new files)" % (key, added))
+        self.trim()
+
+    def _add_object(self, path):
+        digest = hash_file(path)
+        object_path = self.get_object_path(digest)
+        if os.path.exists(object_path):
+            return digest, False
+        tmp_dir = os.path.join(self.root, "tmp")
+        if not os.path.exists(tmp_dir):
+            os.makedirs(tmp_dir)
+        tmp_path = os.path.join(tmp_dir, "%s-%s" % (os.getpid(),
+            os.path.basename(path)))
+        try:
+            shutil.copyfile(path, tmp_path)
+            object_dir = os.path.dirname(object_path)
+            if not os.path.exists(object_dir):
+                os.makedirs(object_dir)
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+            if sys.platform == "win32" and os.path.exists(object_path):
+                os.remove(object_path)
+            os.rename(tmp_path, object_path)
+            return digest, True
+        finally:
+            _remove(tmp_path)
+
+    def trim(self):
+        object_sizes = {}
+        object_mtimes = {}
+        if os.path.isdir(self.objects_dir):
+            for prefix in os.listdir(self.objects_dir):
+                prefix_dir = os.path.join(self.objects_dir, prefix)
+                for name in os.listdir(prefix_dir):
+                    st = os.stat(os.path.join(prefix_dir, name))
+                    object_sizes[prefix + name] = st.st_size
+                    object_mtimes[prefix + name] = st.st_mtime
+        total = sum(object_sizes.values())
+        if total <= self.max_size:
+            return
+        # Oldest use first
+        entries = []
+        if os.path.isdir(self.entries_dir):
+            for name in os.listdir(self.entries_dir):
+                if not name.endswith(".json"):
+                    continue
+                key = name[:-len(".json")]
+                try:
+                    mtime = os.path.getmtime(self.get_entry_path(key))
+                except OSError:
+                    continue
+                entries.append((mtime, key))
+        entries.sort()
+        refs = {}
+        entry_objects = {}
+        for mtime, key in entries:
+            entry = self.read_entry(key) or {"dirs": {}}
+            digests = set()
+            for items in entry["dirs"].values():
+                for relpath, kind, value, mode in items:
+                    if kind == "f":
+                        digests.add(value)
+            entry_objects[key] = digests
+            for digest in digests:
+                refs[digest] = refs.get(digest, 0) + 1
+        # Objects no artifact refers to are left over from interrupted builds
+        now = time.time()
+        for digest in list(object_sizes.keys()):
+            if not digest in refs and now - object_mtimes[digest] > ORPHAN_AGE:
+                _remove(self.get_object_path(digest))
+                total -= object_sizes.pop(digest)
+        evicted = 0
+        # Always keep the most recent artifact
+        for mtime, key in entries[:-1]:
+            if total <= self.max_size:
+                break
+            _remove(self.get_entry_path(key))
+            evicted += 1
+            for digest in entry_objects[key]:
+                refs[digest] -= 1
+                if refs[digest] == 0 and digest in object_sizes:
+                    _remove(self.get_object_path(digest))
+                    total -= object_sizes.pop(digest)
+        if evicted:
+            log.info("Evicted %d artifacts from %s, %d MB left" %
+                (evicted, self.root, total // (1024 * 1024)))
+
+
+# Artifact backends by url scheme, the local store handles plain paths
+BACKENDS = {
+    "file": LocalArtifactStore,
+}
+
+
+def open_artifact_cache(location, max_size=DEFAULT_MAX_SIZE):
+    """Return the backend for "scheme://location", or a local store for a
+    plain directory"""
+    scheme, sep, path = location.partition("://")
+    if not sep:
+        scheme, path = "file", location
+    if not scheme in BACKENDS:
+        raise DistutilsOptionError("Unsupported artifact cache %s, "
+            "available: %s" % (location, ", ".join(sorted(BACKENDS.keys()))))
+    return BACKENDS[scheme](path, max_size)
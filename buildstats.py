@@ -0,0 +1,315 @@
+import os
+import re
+import sys
+import time
+import threading
+
+from distutils import log
+
+from utils import read_json_file
+from utils import write_json_file
+from procsampler import ProcessSampler
+from procsampler import PhaseMonitor
+from procsampler import is_supported as is_sampler_supported
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Minimum seconds between two progress reports of a phase
+PROGRESS_INTERVAL = 5.0
+
+# "[ 45%] Building CXX object ..." from make, "[12/345] ..." from ninja
+MAKE_PROGRESS_RE = re.compile(br"^\[\s*(\d+)%\]")
+NINJA_PROGRESS_RE = re.compile(br"^\[(\d+)/(\d+)\]")
+
+
+def get_children_max_rss():
+    """Return the peak RSS in KB of the largest finished child process"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == "darwin":
+        # Reported in bytes on OS X, in kilobytes everywhere else
+        max_rss = max_rss // 1024
+    return max_rss
+
+
+def get_cpu_time():
+    """Return the CPU time used by this process and its finished children"""
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return "%dm%02ds" % (minutes, seconds)
+
+
+def estimate_remaining(elapsed, fraction, expected=None):
+    """Estimate the remaining seconds of a phase that is `fraction` done
+
+    The duration of the phase in the previous build is trusted at first,
+    and the extrapolation of the current progress as the phase advances.
+    """
+    if fraction <= 0:
+        if expected is None:
+            return None
+        return max(0.0, expected - elapsed)
+    total = elapsed / fraction
+    if expected is not None:
+        total = (1 - fraction) * expected + fraction * total
+    return max(0.0, total - elapsed)
+
+
+class PhaseProgress(object):
+    """Follows the progress markers in the output of make or ninja
+
+    Lines are passed to add_line() as they are read, make reports the
+    percentage of the targets done and ninja the number of edges.
+    """
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self.fraction = 0.0
+
+    def add_line(self, line):
+        match = MAKE_PROGRESS_RE.match(line)
+        if match:
+            done, total = int(match.group(1)), 100
+        else:
+            match = NINJA_PROGRESS_RE.match(line)
+            if not match:
+                return
+            done, total = int(match.group(1)), int(match.group(2))
+        if not total:
+            return
+        # Parallel make jobs may print their markers out of order
+        fraction = min(1.0, float(done) / total)
+        if fraction > self.fraction:
+            self.fraction = fraction
+            self.stats.update_progress(self.name, fraction, done, total)
+
+
+class PhaseTimer(object):
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self.start_time = None
+        self.start_cpu = None
+
+    def __enter__(self):
+        self.start_time = time.time()
+        self.start_cpu = get_cpu_time()
+        self.stats.start_phase(self.name, self.start_time)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        record = {
+            "name": self.name,
+            "start": self.start_time,
+            "wall_time": time.time() - self.start_time,
+            "cpu_time": get_cpu_time() - self.start_cpu,
+            "children_max_rss_kb": get_children_max_rss(),
+            "status": exc_type is None and "ok" or "failed",
+        }
+        resources = self.stats.pop_resources(self.name)
+        if resources:
+            record["resources"] = resources
+        self.stats.add_phase(record)
+        # Don't swallow the exception
+        return False
+
+
+class BuildStats(object):
+    """Collects the wall time, CPU time and child process peak RSS of the
+    build phases and writes them to a json report.
+
+    The CPU times are process wide and include the finished child
+    processes, so phases running at the same time are accounted to each
+    other. The peak RSS is the high-water mark over all child processes
+    finished so far.
+    """
+    def __init__(self):
+        self.phases = []
+        self.report_path = None
+        self.status_path = None
+        self.info = {}
+        # Wall time of the last successful run of every phase, kept across
+        # the builds that skip or fail a phase
+        self.history = {}
+        # Start time and progress of the running phases
+        self.running = {}
+        self._last_report = {}
+        self.sampler = None
+        self._lock = threading.Lock()
+
+    def phase(self, name):
+        return PhaseTimer(self, name)
+
+    def progress(self, name):
+        return PhaseProgress(self, name)
+
+    def start_sampler(self, interval):
+        """Sample the resources used by the commands of the phases"""
+        if not is_sampler_supported():
+            log.warn("Resource sampling needs /proc, it is only supported on Linux")
+            return
+        self.sampler = ProcessSampler(interval)
+        self.sampler.start()
+
+    def stop_sampler(self):
+        if self.sampler is None:
+            return
+        self.sampler.stop()
+        self.sampler.join()
+        self.sampler = None
+
+    def monitor(self, name):
+        """Return the object run_process registers the commands of the
+        phase with, or None when the resources are not sampled"""
+        if self.sampler is None:
+            return None
+        return PhaseMonitor(self.sampler, name)
+
+    def pop_resources(self, name):
+        if self.sampler is None:
+            return None
+        return self.sampler.pop_summary(name)
+
+    def start_phase(self, name, start_time):
+        self._lock.acquire()
+        try:
+            self.running[name] = {"start": start_time}
+        finally:
+            self._lock.release()
+        self.save_status()
+
+    def add_phase(self, record):
+        log.info("Phase %s finished in %.1f s (%s)" %
+            (record["name"], record["wall_time"], record["status"]))
+        self._lock.acquire()
+        try:
+            self.phases.append(record)
+            self.running.pop(record["name"], None)
+        finally:
+            self._lock.release()
+        self.save()
+        self.save_status()
+
+    def set_report_path(self, report_path, **info):
+        previous = read_json_file(report_path) or {}
+        self.history.update(previous.get("history") or {})
+        for p in previous.get("phases", []):
+            if p.get("status") == "ok":
+                self.history[p["name"]] = p["wall_time"]
+        self.report_path = report_path
+        self.info.update(info)
+        self.save()
+
+    def set_info(self, name, value):
+        """Record a value in the report and the status file"""
+        self._lock.acquire()
+        try:
+            self.info[name] = value
+        finally:
+            self._lock.release()
+        self.save()
+        self.save_status()
+
+    def set_status_path(self, status_path):
+        """Keep the progress of the running phases in a json file that
+        other tools can poll"""
+        self.status_path = status_path
+        self.save_status()
+
+    def update_progress(self, name, fraction, done, total):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            state = self.running.get(name)
+            if state is None:
+                return
+            elapsed = now - state["start"]
+            remaining = estimate_remaining(elapsed, fraction,
+                self.history.get(name))
+            state.update({
+                "percent": round(100 * fraction, 1),
+                "done": done,
+                "total": total,
+                "eta": remaining,
+            })
+            if fraction < 1 and \
+                now - self._last_report.get(name, 0) < PROGRESS_INTERVAL:
+                return
+            self._last_report[name] = now
+        finally:
+            self._lock.release()
+        message = "%s: %d%% (%d/%d), %s elapsed" % (name, 100 * fraction,
+            done, total, format_duration(elapsed))
+        if remaining is not None:
+            message += ", about %s left" % format_duration(remaining)
+        log.info(message)
+        self.save_status()
+
+    def save_status(self):
+        if not self.status_path:
+            return
+        self._lock.acquire()
+        try:
+            now = time.time()
+            running = {}
+            for name, state in self.running.items():
+                running[name] = dict(state)
+                running[name]["elapsed"] = now - state["start"]
+            status = dict(self.info)
+            status.update({
+                "pid": os.getpid(),
+                "updated": now,
+                "running": running,
+                "finished": [{"name": p["name"], "status": p["status"],
+                    "wall_time": p["wall_time"]} for p in self.phases],
+            })
+            write_json_file(self.status_path, status)
+        except (IOError, OSError):
+            # Only informative, never fail the build because of it
+            pass
+        finally:
+            self._lock.release()
+
+    def save(self):
+        if not self.report_path:
+            return
+        self._lock.acquire()
+        try:
+            report = dict(self.info)
+            report["phases"] = list(self.phases)
+            report["total_wall_time"] = sum(
+                [p["wall_time"] for p in self.phases])
+            history = dict(self.history)
+            for p in self.phases:
+                if p["status"] == "ok":
+                    history[p["name"]] = p["wall_time"]
+            report["history"] = history
+            write_json_file(self.report_path, report)
+        finally:
+            self._lock.release()
+
+    def log_summary(self):
+        log.info("=" * 30)
+        log.info("Build phases:")
+        for p in self.phases:
+            log.info("  %-30s %8.1f s wall %8.1f s cpu  %s" %
+                (p["name"], p["wall_time"], p["cpu_time"], p["status"]))
+            resources = p.get("resources")
+            if resources:
+                iowait = resources["system_iowait_percent"]
+                log.info("  %-30s %8d MB peak %8.1f parallel  %s%% iowait" %
+                    ("", resources["peak_rss_kb"] // 1024,
+                    resources["average_parallelism"],
+                    iowait is None and "?" or "%.1f" % iowait))
+        if self.report_path:
+            log.info("Timing report: %s" % self.report_path)
+        log.info("=" * 30)
@@ -0,0 +1,210 @@
+import os
+import sys
+import time
+import threading
+
+from distutils import log
+
+try:
+    CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+    PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    # Not a POSIX system, the sampler is not available anyway
+    CLOCK_TICKS = 100
+    PAGE_SIZE = 4096
+
+
+def is_supported():
+    return sys.platform.startswith("linux") and os.path.exists("/proc/self/stat")
+
+
+def read_process_stat(pid):
+    """Return (ppid, cpu ticks, rss pages, block I/O delay ticks) of a
+    process, or None when it is gone"""
+    try:
+        f = open("/proc/%s/stat" % pid, "rb")
+        try:
+            data = f.read()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return None
+    # The command name may contain spaces and parentheses
+    fields = data[data.rfind(b")") + 2:].split()
+    try:
+        # Fields 4, 14, 15, 24 and 42 of proc(5)
+        return (int(fields[1]), int(fields[11]) + int(fields[12]),
+            int(fields[21]), len(fields) > 39 and int(fields[39]) or 0)
+    except (IndexError, ValueError):
+        return None
+
+
+def read_process_table():
+    """Return {pid: stat} for all the processes"""
+    table = {}
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            stat = read_process_stat(name)
+            if stat is not None:
+                table[int(name)] = stat
+    return table
+
+
+def read_system_cpu_ticks():
+    """Return (iowait ticks, total ticks) of all the CPUs"""
+    try:
+        f = open("/proc/stat", "r")
+        try:
+            values = [int(v) for v in f.readline().split()[1:]]
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError):
+        return None
+    # user nice system idle iowait irq softirq steal guest guest_nice,
+    # the guest times are part of user and nice already
+    return values[4], sum(values[:8])
+
+
+class PhaseSamples(object):
+    def __init__(self):
+        self.roots = set()
+        self.start_time = time.time()
+        self.start_system = read_system_cpu_ticks()
+        self.cpu_ticks = 0
+        self.io_ticks = 0
+        self.peak_rss = 0
+        self.max_processes = 0
+        self.samples = 0
+
+    def get_summary(self):
+        wall_time = time.time() - self.start_time
+        cpu_time = float(self.cpu_ticks) / CLOCK_TICKS
+        summary = {
+            "samples": self.samples,
+            "peak_rss_kb": self.peak_rss * PAGE_SIZE // 1024,
+            "sampled_cpu_time": cpu_time,
+            "average_parallelism": wall_time and cpu_time / wall_time or 0.0,
+            "max_processes": self.max_processes,
+            "io_delay_time": float(self.io_ticks) / CLOCK_TICKS,
+            "system_iowait_percent": None,
+        }
+        end_system = read_system_cpu_ticks()
+        if self.start_system and end_system:
+            total = end_system[1] - self.start_system[1]
+            if total > 0:
+                summary["system_iowait_percent"] = \
+                    100.0 * (end_system[0] - self.start_system[0]) / total
+        return summary
+
+
+class ProcessSampler(threading.Thread):
+    """Samples the process trees of the running build commands
+
+    Every interval the CPU time, RSS and block I/O delay of all the
+    processes below the registered commands are read from /proc and
+    accounted to the phase of the command. The CPU time of a process is
+    counted up to its last sample, so processes living for less than an
+    interval are missed. The block I/O delay needs the kernel delay
+    accounting (kernel.task_delayacct), the system-wide iowait share of
+    the CPUs is reported either way.
+    """
+    def __init__(self, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.phases = {}
+        # Last CPU and I/O delay ticks seen for every sampled process
+        self.last_ticks = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def add_process(self, name, pid):
+        self.lock.acquire()
+        try:
+            if not name in self.phases:
+                self.phases[name] = PhaseSamples()
+            self.phases[name].roots.add(pid)
+        finally:
+            self.lock.release()
+
+    def remove_process(self, name, pid):
+        self.lock.acquire()
+        try:
+            if name in self.phases:
+                self.phases[name].roots.discard(pid)
+        finally:
+            self.lock.release()
+
+    def pop_summary(self, name):
+        self.lock.acquire()
+        try:
+            samples = self.phases.pop(name, None)
+        finally:
+            self.lock.release()
+        return samples and samples.get_summary()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.sample()
+            except Exception:
+                log.warn("Process sampling failed: %s" % sys.exc_info()[1])
+                return
+
+    def sample(self):
+        self.lock.acquire()
+        try:
+            roots = [(name, list(samples.roots))
+                for name, samples in self.phases.items() if samples.roots]
+        finally:
+            self.lock.release()
+        if not roots:
+            return
+        table = read_process_table()
+        children = {}
+        for pid, stat in table.items():
+            children.setdefault(stat[0], []).append(pid)
+        last_ticks = {}
+        for name, pids in roots:
+            cpu_ticks = io_ticks = rss = count = 0
+            pending = [pid for pid in pids if pid in table]
+            while pending:
+                pid = pending.pop()
+                ppid, cpu, pages, io = table[pid]
+                last_cpu, last_io = self.last_ticks.get(pid, (0, 0))
+                cpu_ticks += max(0, cpu - last_cpu)
+                io_ticks += max(0, io - last_io)
+                last_ticks[pid] = (cpu, io)
+                rss += pages
+                count += 1
+                pending.extend(children.get(pid, []))
+            self.lock.acquire()
+            try:
+                samples = self.phases.get(name)
+                if samples is None:
+                    continue
+                samples.cpu_ticks += cpu_ticks
+                samples.io_ticks += io_ticks
+                samples.peak_rss = max(samples.peak_rss, rss)
+                samples.max_processes = max(samples.max_processes, count)
+                samples.samples += 1
+            finally:
+                self.lock.release()
+        # Forget the processes that are gone, their pids may be reused
+        self.last_ticks = last_ticks
+
+
+class PhaseMonitor(object):
+    """Registers the commands of a phase with the sampler"""
+    def __init__(self, sampler, name):
+        self.sampler = sampler
+        self.name = name
+
+    def add_process(self, pid):
+        self.sampler.add_process(self.name, pid)
+
+    def remove_process(self, pid):
+        self.sampler.remove_process(self.name, pid)
@@ -1,13 +1,20 @@
+import os
 import sys
 import subprocess
 from distutils.spawn import find_executable
 
+from utils import read_json_file
+from utils import write_json_file
+
 class QtInfo(object):
-    def __init__(self, qmake_path=None):
+    def __init__(self, qmake_path=None, cache_file=None):
         if qmake_path:
             self._qmake_path = qmake_path
         else:
             self._qmake_path = find_executable("qmake")
+        # Optional json file keeping the "qmake -query" results between runs
+        self._cache_file = cache_file
+        self._properties = None
 
     def getQMakePath(self):
         return self._qmake_path
@@ -34,15 +41,72 @@ class QtInfo(object):
         return self.getProperty("QT_INSTALL_HEADERS")
 
     def getProperty(self, prop_name):
-        cmd = [self._qmake_path, "-query", prop_name]
-        proc = subprocess.Popen(cmd, stdout = subprocess.PIPE, shell=False)
-        prop = proc.communicate()[0]
+        return self.getProperties().get(prop_name)
+
+    def getProperties(self):
+        if self._properties is None:
+            self._properties = self._readCache()
+            if self._properties is None:
+                self._properties = self._queryProperties()
+                if self._properties:
+                    self._writeCache(self._properties)
+        return self._properties
+
+    def _queryProperties(self):
+        # Without a property name qmake dumps all of them as "NAME:value" lines
+        cmd = [self._qmake_path, "-query"]
+        try:
+            proc = subprocess.Popen(cmd, stdout = subprocess.PIPE, shell=False)
+        except OSError:
+            return {}
+        output = proc.communicate()[0]
         proc.wait()
         if proc.returncode != 0:
-            return None
+            return {}
         if sys.version_info >= (3,):
-            return str(prop, 'ascii').strip()
-        return prop.strip()
+            output = str(output, 'utf-8')
+        props = {}
+        for line in output.splitlines():
+            name, sep, value = line.partition(':')
+            if sep:
+                props[name.strip()] = value.strip()
+        return props
+
+    def _getCacheKey(self):
+        qmake_path = os.path.abspath(self._qmake_path)
+        st = os.stat(qmake_path)
+        return qmake_path, st.st_size, st.st_mtime
+
+    def _loadCacheFile(self):
+        return read_json_file(self._cache_file) or {}
+
+    def _readCache(self):
+        if not self._cache_file or not self._qmake_path:
+            return None
+        try:
+            qmake_path, size, mtime = self._getCacheKey()
+        except OSError:
+            return None
+        entry = self._loadCacheFile().get(qmake_path)
+        if not entry or entry.get("size") != size or entry.get("mtime") != mtime:
+            return None
+        return entry.get("properties")
+
+    def _writeCache(self, props):
+        if not self._cache_file:
+            return
+        try:
+            qmake_path, size, mtime = self._getCacheKey()
+            cache = self._loadCacheFile()
+            cache[qmake_path] = {
+                "size": size,
+                "mtime": mtime,
+                "properties": props,
+            }
+            write_json_file(self._cache_file, cache)
+        except (IOError, OSError):
+            # qmake is queried again next time
+            pass
 
     version = property(getVersion)
     bins_dir = property(getBinsPath)
@@ -52,3 +116,4 @@ class QtInfo(object):
     imports_dir = property(getImportsPath)
     translations_dir = property(getTranslationsPath)
     headers_dir = property(getHeadersPath)
+    properties = property(getProperties)
@@ -46,13 +46,19 @@ except ImportError:
 import os
 import sys
 import platform
+import fnmatch
+import shlex
+import tarfile
+import subprocess
 
 from distutils import log
 from distutils.errors import DistutilsOptionError
 from distutils.errors import DistutilsSetupError
+from distutils.errors import DistutilsExecError
 from distutils.sysconfig import get_config_var
 from distutils.sysconfig import get_python_lib
 from distutils.spawn import find_executable
+from distutils.core import Command
 from distutils.command.build import build as _build
 from distutils.command.build_ext import build_ext as _build_ext
 
@@ -60,8 +66,23 @@ from setuptools import setup, Extension
 from setuptools.command.install import install as _install
 from setuptools.command.bdist_egg import bdist_egg as _bdist_egg
 from setuptools.command.develop import develop as _develop
+from setuptools.command.egg_info import egg_info as _egg_info
+from setuptools.command.sdist import sdist as _sdist
 
 from qtinfo import QtInfo
+from buildstats import BuildStats
+from taskgraph import TaskGraph
+from artifactcache import open_artifact_cache
+from artifactcache import parse_size
+from artifactcache import DEFAULT_MAX_SIZE
+from wheelfile import WheelWriter
+from wheelfile import parse_compress_rules
+from wheelfile import get_wheel_name
+from wheelfile import get_python_tag
+from wheelfile import get_abi_tag
+from wheelfile import get_platform_tag
+from wheelfile import get_metadata_content
+from wheelfile import get_wheel_content
 from utils import rmtree
 from utils import makefile
 from utils import copyfile
@@ -72,6 +93,25 @@ from utils import option_value
 from utils import update_env_path
 from utils import init_msvc_env
 from utils import regenerate_qt_resources
+from utils import fingerprint
+from utils import read_fingerprint
+from utils import write_fingerprint
+from utils import get_compiler_identity
+from utils import get_default_jobs
+from utils import find_compiler_cache
+from utils import init_compiler_cache_env
+from utils import get_compiler_cache_stats
+from utils import git_output
+from utils import get_process_output
+from utils import hash_file
+from utils import get_needed_closure
+from utils import get_elf_build_id
+from utils import read_json_file
+from utils import write_json_file
+from utils import get_file_identity
+
+# Timings of the build phases, written next to the install folder
+build_stats = BuildStats()
 
 # Declare options
 OPTION_DEBUG = has_option("debug")
@@ -80,7 +120,13 @@ OPTION_QMAKE = option_value("qmake")
 OPTION_CMAKE = option_value("cmake")
 OPTION_ONLYPACKAGE = has_option("only-package")
 OPTION_STANDALONE = has_option("standalone")
-OPTION_VERSION = option_value("version")
+# A bare --version is the distutils query of the package version
+if "--version" in sys.argv[-1:] or \
+    "--version" in sys.argv and \
+    sys.argv[sys.argv.index("--version") + 1].startswith("-"):
+    OPTION_VERSION = None
+else:
+    OPTION_VERSION = option_value("version")
 OPTION_LISTVERSIONS = has_option("list-versions")
 OPTION_MAKESPEC = option_value("make-spec")
 OPTION_IGNOREGIT = has_option("ignore-git")
@@ -88,11 +134,22 @@ OPTION_JOBS = option_value('jobs')                # number of parallel build job
 OPTION_JOM = has_option('jom')                    # use jom instead of nmake with msvc
 OPTION_BUILDTESTS = has_option("build-tests")
 OPTION_OSXARCH = option_value("osx-arch")
-
-if OPTION_QMAKE is None:
-    OPTION_QMAKE = find_executable("qmake")
-if OPTION_CMAKE is None:
-    OPTION_CMAKE = find_executable("cmake")
+OPTION_INCREMENTAL = has_option("incremental")
+OPTION_COMPILER_CACHE = option_value("compiler-cache")
+OPTION_COMPILER_CACHE_DIR = option_value("compiler-cache-dir")
+OPTION_GIT_MIRROR = option_value("git-mirror")
+OPTION_GIT_DEPTH = option_value("git-depth")
+OPTION_GIT_OFFLINE = has_option("git-offline")
+OPTION_SPLIT_DEBUG = has_option("split-debug")
+OPTION_DEBUG_ARCHIVE = has_option("debug-archive")
+OPTION_WHEEL_COMPRESSION = option_value("wheel-compression")
+OPTION_SKIP_PACKAGING = has_option("skip-packaging")
+OPTION_MATRIX_PYTHON = option_value("matrix-python")
+OPTION_MATRIX_QMAKE = option_value("matrix-qmake")
+OPTION_MATRIX_BUILD_TYPE = option_value("matrix-build-type")
+OPTION_ARTIFACT_CACHE = option_value("artifact-cache")
+OPTION_ARTIFACT_CACHE_SIZE = option_value("artifact-cache-size")
+OPTION_MONITOR_INTERVAL = option_value("monitor-interval")
 
 if sys.platform == "win32":
     if OPTION_MAKESPEC is None:
@@ -103,8 +160,8 @@ if sys.platform == "win32":
 else:
     if OPTION_MAKESPEC is None:
         OPTION_MAKESPEC = "make"
-    if not OPTION_MAKESPEC in ["make"]:
-        print("Invalid option --make-spec. Available values are %s" % (["make"]))
+    if not OPTION_MAKESPEC in ["make", "ninja"]:
+        print("Invalid option --make-spec. Available values are %s" % (["make", "ninja"]))
         sys.exit(1)
 
 if OPTION_JOM:
@@ -112,13 +169,19 @@ if OPTION_JOM:
         print("Option --jom can only be used with msvc")
         sys.exit(1)
 
+# Only nmake can't run parallel jobs
+NMAKE = sys.platform == 'win32' and OPTION_MAKESPEC == 'msvc' and not OPTION_JOM
+
 if OPTION_JOBS:
-    if sys.platform == 'win32' and not OPTION_JOM:
-        print("Option --jobs can only be used with --jom on Windows.")
+    if NMAKE:
+        print("Option --jobs can only be used with --jom or mingw on Windows.")
         sys.exit(1)
     else:
         if not OPTION_JOBS.startswith('-j'):
             OPTION_JOBS = '-j' + OPTION_JOBS
+elif not NMAKE:
+    # Size the build by the available CPUs instead of compiling serially
+    OPTION_JOBS = '-j%s' % get_default_jobs()
 else:
     OPTION_JOBS = ''
 
@@ -159,41 +222,170 @@ Use --list-versions option to get list of available versions""" % OPTION_VERSION
     __version__ = OPTION_VERSION
 
     
-# Initialize, pull and checkout submodules
-if os.path.isdir(".git") and not OPTION_IGNOREGIT and not OPTION_ONLYPACKAGE:
-    print("Initializing submodules for Shiboken version %s" % __version__)
-    git_update_cmd = ["git", "submodule", "update", "--init"]
-    if run_process(git_update_cmd) != 0:
-        raise DistutilsSetupError("Failed to initialize the git submodules")
-    git_pull_cmd = ["git", "submodule", "foreach", "git", "fetch", "origin"]
-    if run_process(git_pull_cmd) != 0:
-        raise DistutilsSetupError("Failed to initialize the git submodules")
-    git_pull_cmd = ["git", "submodule", "foreach", "git", "pull", "origin", "master"]
-    if run_process(git_pull_cmd) != 0:
-        raise DistutilsSetupError("Failed to initialize the git submodules")
-    submodules_dir = os.path.join(script_dir, "sources")
-    for m in submodules[__version__]:
-        module_name = m[0]
-        module_version = m[1]
-        print("Checking out submodule %s to branch %s" % (module_name, module_version))
-        module_dir = os.path.join(submodules_dir, module_name)
-        os.chdir(module_dir)
-        git_checkout_cmd = ["git", "checkout", module_version]
-        if run_process(git_checkout_cmd) != 0:
-            raise DistutilsSetupError("Failed to initialize the git submodule %s" % module_name)
-        os.chdir(script_dir)
-
-# Clean up temp and package folders
-for n in ["shiboken_package", "build", "Shiboken-%s" % __version__]:
-    d = os.path.join(script_dir, n)
-    if os.path.isdir(d):
-        print("Removing %s" % d)
-        rmtree(d)
-
-# Prepare package folders
-for pkg in ["shiboken_package/Shiboken"]:
-    pkg_dir = os.path.join(script_dir, pkg)
-    os.makedirs(pkg_dir)
+def get_submodule_mirror(module_name):
+    if not OPTION_GIT_MIRROR:
+        return None
+    # Either a directory with <module>.git mirrors, or the mirror itself
+    mirror_dir = os.path.join(OPTION_GIT_MIRROR, module_name + ".git")
+    if not os.path.isdir(mirror_dir):
+        mirror_dir = OPTION_GIT_MIRROR
+    return os.path.abspath(mirror_dir)
+
+
+def add_git_alternate(module_dir, mirror_dir):
+    """Let the submodule borrow the objects of a local mirror"""
+    git_dir = git_output(["rev-parse", "--git-dir"], cwd=module_dir)
+    if git_dir is None:
+        return
+    mirror_objects = os.path.join(mirror_dir, "objects")
+    if not os.path.isdir(mirror_objects):
+        mirror_objects = os.path.join(mirror_dir, ".git", "objects")
+    alternates_path = os.path.join(module_dir, git_dir, "objects", "info", "alternates")
+    alternates = []
+    if os.path.exists(alternates_path):
+        alternates = [l.strip() for l in open(alternates_path).readlines()]
+    if not mirror_objects in alternates:
+        print("Using objects from git mirror %s" % mirror_dir)
+        f = open(alternates_path, "a")
+        f.write(mirror_objects + "\n")
+        f.close()
+
+
+def get_local_pinned_commit(module_dir, ref):
+    """Return the commit of `ref` when it is a tag or commit id already
+    present in the submodule. Branches move, so they don't count."""
+    commit = git_output(["rev-parse", "--verify", "--quiet",
+        "refs/tags/%s^{commit}" % ref], cwd=module_dir)
+    if commit is None and len(ref) >= 7 and \
+        not [c for c in ref.lower() if c not in "0123456789abcdef"]:
+        commit = git_output(["rev-parse", "--verify", "--quiet",
+            "%s^{commit}" % ref], cwd=module_dir)
+    return commit
+
+
+def sync_submodule(module_name, module_version):
+    module_dir = os.path.join(script_dir, "sources", module_name)
+    mirror_dir = get_submodule_mirror(module_name)
+    
+    if not os.path.exists(os.path.join(module_dir, ".git")):
+        if OPTION_GIT_OFFLINE and not mirror_dir:
+            raise DistutilsSetupError(
+                "The git submodule %s is not initialized and --git-offline was given"
+                % module_name)
+        git_update_cmd = ["git", "submodule", "update", "--init"]
+        if mirror_dir:
+            git_update_cmd += ["--reference", mirror_dir]
+        if OPTION_GIT_DEPTH:
+            git_update_cmd += ["--depth", OPTION_GIT_DEPTH]
+        git_update_cmd += ["--", "sources/%s" % module_name]
+        if run_process(git_update_cmd, cwd=script_dir) != 0:
+            raise DistutilsSetupError("Failed to initialize the git submodules")
+    elif mirror_dir:
+        add_git_alternate(module_dir, mirror_dir)
+    
+    pinned_commit = get_local_pinned_commit(module_dir, module_version)
+    if pinned_commit is not None:
+        # The requested tag or commit is already here, no need to fetch
+        if git_output(["rev-parse", "HEAD"], cwd=module_dir) == pinned_commit:
+            print("Submodule %s is already at %s" % (module_name, module_version))
+            return
+    elif OPTION_GIT_OFFLINE:
+        if git_output(["symbolic-ref", "--quiet", "HEAD"], cwd=module_dir) == \
+            "refs/heads/%s" % module_version:
+            # Nothing to fetch or check out, so leave the checkout alone
+            print("Submodule %s is already on %s" % (module_name, module_version))
+            return
+        print("Skipping fetch of submodule %s (--git-offline)" % module_name)
+    else:
+        # A local mirror is fetched instead of origin, into the same refs
+        git_fetch_cmd = ["git", "fetch", "--tags"]
+        if OPTION_GIT_DEPTH:
+            git_fetch_cmd += ["--depth", OPTION_GIT_DEPTH]
+        if mirror_dir:
+            git_fetch_cmd += [mirror_dir,
+                "+refs/heads/*:refs/remotes/origin/*"]
+        else:
+            git_fetch_cmd += ["origin"]
+        if run_process(git_fetch_cmd, cwd=module_dir) != 0:
+            raise DistutilsSetupError("Failed to fetch the git submodule %s" % module_name)
+    
+    print("Checking out submodule %s to branch %s" % (module_name, module_version))
+    git_checkout_cmd = ["git", "checkout", module_version]
+    if run_process(git_checkout_cmd, cwd=module_dir) != 0:
+        raise DistutilsSetupError("Failed to initialize the git submodule %s" % module_name)
+    if pinned_commit is None and not OPTION_GIT_OFFLINE and \
+        git_output(["rev-parse", "--verify", "--quiet",
+            "refs/remotes/origin/%s" % module_version], cwd=module_dir):
+        # Bring the branch up to date with the fetched one
+        git_merge_cmd = ["git", "merge", "--ff-only", "origin/%s" % module_version]
+        if run_process(git_merge_cmd, cwd=module_dir) != 0:
+            raise DistutilsSetupError("Failed to update the git submodule %s" % module_name)
+
+
+def find_build_tools():
+    """Default --qmake and --cmake to the ones found on the PATH"""
+    global OPTION_QMAKE, OPTION_CMAKE
+    if OPTION_QMAKE is None:
+        OPTION_QMAKE = find_executable("qmake")
+    if OPTION_CMAKE is None:
+        OPTION_CMAKE = find_executable("cmake")
+
+
+def prepare_package_dirs():
+    for pkg in ["shiboken_package/Shiboken"]:
+        pkg_dir = os.path.join(script_dir, pkg)
+        if not os.path.isdir(pkg_dir):
+            os.makedirs(pkg_dir)
+
+
+_sources_prepared = False
+
+def prepare_sources(cleanup=True):
+    """Sync the submodules and clean up the output of the previous build
+
+    Only the commands that build or package call this, so metadata
+    queries like --version or egg_info don't touch git or the folders.
+    Without cleanup the folders of earlier builds are kept.
+    """
+    global _sources_prepared
+    if _sources_prepared:
+        return
+    _sources_prepared = True
+    
+    # Initialize, pull and checkout submodules
+    if os.path.isdir(".git") and not OPTION_IGNOREGIT and not OPTION_ONLYPACKAGE:
+        with build_stats.phase("submodule sync"):
+            print("Initializing submodules for Shiboken version %s" % __version__)
+            for m in submodules[__version__]:
+                sync_submodule(m[0], m[1])
+    
+    # Clean up temp and package folders. The package folders are shared by
+    # all the builds, so leave them alone when not packaging.
+    cleanup_dirs = []
+    if cleanup and not OPTION_SKIP_PACKAGING:
+        cleanup_dirs.append("Shiboken-%s" % __version__)
+        if not OPTION_INCREMENTAL:
+            cleanup_dirs.extend(["shiboken_package", "build"])
+    for n in cleanup_dirs:
+        d = os.path.join(script_dir, n)
+        if os.path.isdir(d):
+            print("Removing %s" % d)
+            rmtree(d)
+    
+    # Prepare package folders
+    prepare_package_dirs()
+
+
+class shiboken_egg_info(_egg_info):
+    def run(self):
+        # The egg-info is written next to the package folder
+        prepare_package_dirs()
+        _egg_info.run(self)
+
+class shiboken_sdist(_sdist):
+    def run(self):
+        prepare_sources()
+        _sdist.run(self)
 
 class shiboken_install(_install):
     def run(self):
@@ -214,7 +406,8 @@ class shiboken_install(_install):
                 filename,
                 "-install"
             ]
-            run_process(cmd)
+            with build_stats.phase("postinstall"):
+                run_process(cmd)
 
 class shiboken_develop(_develop):
 
@@ -234,6 +427,224 @@ class shiboken_bdist_egg(_bdist_egg):
         self.run_command("build")
         _bdist_egg.run(self)
 
+class shiboken_bdist_wheel(Command):
+
+    description = "create a wheel distribution from the Shiboken package folder"
+
+    user_options = [
+        ('dist-dir=', 'd', "directory to put the wheel in"),
+    ]
+
+    def initialize_options(self):
+        self.dist_dir = None
+
+    def finalize_options(self):
+        if self.dist_dir is None:
+            self.dist_dir = "dist"
+
+    def run(self):
+        # Validate the option before spending time on the build
+        default_level, compress_rules = parse_compress_rules(
+            OPTION_WHEEL_COMPRESSION)
+        self.run_command("build")
+        with build_stats.phase("wheel"):
+            self.write_wheel(default_level, compress_rules)
+
+    def write_wheel(self, default_level, compress_rules):
+        metadata = self.distribution.metadata
+        name = "%s-%s" % (metadata.get_name(), metadata.get_version())
+        dist_info_dir = name + ".dist-info"
+        if not os.path.exists(self.dist_dir):
+            os.makedirs(self.dist_dir)
+        wheel_path = os.path.join(self.dist_dir, get_wheel_name(metadata))
+        writer = WheelWriter(wheel_path, dist_info_dir, default_level,
+            compress_rules)
+        # <setup>/shiboken_package/* -> <wheel>/*
+        package_dir = os.path.join(script_dir, "shiboken_package")
+        top_level = []
+        for package in self.distribution.packages:
+            top_level.append(package.split(".")[0])
+            src_dir = os.path.join(package_dir, *package.split("."))
+            for root, dirs, files in os.walk(src_dir):
+                for filename in files:
+                    path = os.path.join(root, filename)
+                    arcname = os.path.relpath(path, package_dir)
+                    writer.add_file(arcname.replace(os.sep, "/"), path)
+        # Scripts go to the data folder, with the interpreter line left
+        # to the installer
+        for script in self.distribution.scripts or []:
+            f = open(script, "rb")
+            try:
+                content = f.read()
+            finally:
+                f.close()
+            if content.startswith(b"#!") and b"python" in content.split(b"\n", 1)[0]:
+                content = b"#!python" + content[content.index(b"\n"):]
+            writer.add_data("%s.data/scripts/%s" % (name, os.path.basename(script)),
+                content, 0o755)
+        tag = "%s-%s-%s" % (get_python_tag(), get_abi_tag(), get_platform_tag())
+        writer.add_data(dist_info_dir + "/METADATA",
+            get_metadata_content(metadata))
+        writer.add_data(dist_info_dir + "/WHEEL",
+            get_wheel_content("shiboken setup.py", tag))
+        writer.add_data(dist_info_dir + "/top_level.txt",
+            "\n".join(sorted(set(top_level))) + "\n")
+        writer.close()
+        log.info("Created wheel %s" % wheel_path)
+
+class shiboken_build_matrix(Command):
+
+    description = "build several python, qt and build type combinations at once"
+
+    user_options = []
+
+    def initialize_options(self):
+        pass
+
+    def finalize_options(self):
+        pass
+
+    def get_combinations(self):
+        pythons = OPTION_MATRIX_PYTHON and OPTION_MATRIX_PYTHON.split(",") or \
+            [sys.executable]
+        qmakes = OPTION_MATRIX_QMAKE and OPTION_MATRIX_QMAKE.split(",") or \
+            [OPTION_QMAKE]
+        build_types = OPTION_MATRIX_BUILD_TYPE and \
+            OPTION_MATRIX_BUILD_TYPE.split(",") or ["release"]
+        for build_type in build_types:
+            if not build_type in ("release", "debug", "relwithdebinfo"):
+                raise DistutilsOptionError("Invalid build type %s, expected "
+                    "release, debug or relwithdebinfo" % build_type)
+        combinations = []
+        for python in pythons:
+            for qmake in qmakes:
+                if not qmake:
+                    raise DistutilsOptionError("qmake not found, use --matrix-qmake")
+                for build_type in build_types:
+                    combinations.append((python.strip(), qmake.strip(), build_type))
+        # Two combinations with the same build name would build in the same
+        # folders, e.g. an interpreter given twice or through a symlink
+        build_names = {}
+        for python, qmake, build_type in combinations:
+            build_name = self.get_build_name(python, qmake, build_type)
+            if build_name in build_names:
+                raise DistutilsOptionError("python %s with qmake %s and "
+                    "python %s with qmake %s both build %s" %
+                    (build_names[build_name] + (python, qmake, build_name)))
+            build_names[build_name] = (python, qmake)
+        return combinations
+
+    def get_build_name(self, python, qmake, build_type):
+        """Return the build name the build command of a combination uses"""
+        python_info = get_process_output([python, "-c",
+            "import sys, platform; print('%s.%s %s' % (sys.version_info[0], "
+            "sys.version_info[1], platform.architecture()[0]))"])
+        if not python_info:
+            raise DistutilsOptionError("Failed to query the version of "
+                "python %s" % python)
+        py_version, arch = python_info.split()
+        qt_version = QtInfo(qmake, cache_file=os.path.join(script_dir,
+            "shiboken_build", "qtinfo.json")).version
+        if not qt_version:
+            raise DistutilsOptionError("Failed to query the Qt version with "
+                "qmake %s" % qmake)
+        return "py%s-qt%s-%s-%s" % (py_version, qt_version, arch, build_type)
+
+    def get_build_cmd(self, python, qmake, build_type, jobs):
+        cmd = [python, os.path.join(script_dir, "setup.py"), "build",
+            "--qmake=%s" % qmake, "--skip-packaging"]
+        if build_type != "release":
+            cmd.append("--%s" % build_type)
+        if jobs:
+            cmd.append("--jobs=%d" % jobs)
+        # The submodules were synced once by this process, the builds only
+        # check them
+        if OPTION_IGNOREGIT:
+            cmd.append("--ignore-git")
+        else:
+            cmd.append("--git-offline")
+            if OPTION_VERSION:
+                cmd.append("--version=%s" % OPTION_VERSION)
+        for name, value in [
+            ("cmake", OPTION_CMAKE),
+            ("make-spec", OPTION_MAKESPEC),
+            ("osx-arch", OPTION_OSXARCH),
+            ("compiler-cache", OPTION_COMPILER_CACHE),
+            ("compiler-cache-dir", OPTION_COMPILER_CACHE_DIR),
+            ("artifact-cache", OPTION_ARTIFACT_CACHE),
+            ("artifact-cache-size", OPTION_ARTIFACT_CACHE_SIZE),
+            ("monitor-interval", OPTION_MONITOR_INTERVAL)]:
+            if value:
+                cmd.append("--%s=%s" % (name, value))
+        for name, enabled in [
+            ("incremental", OPTION_INCREMENTAL),
+            ("build-tests", OPTION_BUILDTESTS),
+            ("jom", OPTION_JOM)]:
+            if enabled:
+                cmd.append("--%s" % name)
+        return cmd
+
+    def run(self):
+        find_build_tools()
+        # The builds only use their own folders, the package folders of an
+        # earlier build are kept
+        prepare_sources(cleanup=False)
+        combinations = self.get_combinations()
+        # All the builds share the CPU budget of --jobs
+        cpus = OPTION_JOBS and int(OPTION_JOBS[2:]) or get_default_jobs()
+        max_builds = max(1, min(len(combinations), cpus))
+        jobs = None
+        if OPTION_JOBS:
+            jobs = max(1, cpus // max_builds)
+        log_dir = os.path.join(script_dir, "shiboken_install")
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        build_stats.set_report_path(
+            os.path.join(log_dir, "matrix-timings.json"), version=__version__)
+        log.info("Building %d combinations, %d at a time with %s jobs each" %
+            (len(combinations), max_builds, jobs or "default"))
+
+        failures = []
+        graph = TaskGraph()
+        for index, (python, qmake, build_type) in enumerate(combinations):
+            name = "matrix %d" % index
+            cmd = self.get_build_cmd(python, qmake, build_type, jobs)
+            log_path = os.path.join(log_dir, "matrix-%d.log" % index)
+            log.info("Build %d: python %s, qmake %s, %s (log %s)" %
+                (index, python, qmake, build_type, log_path))
+            graph.add(name, self.make_build_task(name, cmd, log_path, failures))
+        graph.run(max_workers=max_builds)
+
+        build_stats.log_summary()
+        if failures:
+            for name, log_path in failures:
+                log.error("%s failed, see %s" % (name, log_path))
+            raise DistutilsSetupError("%d of %d matrix builds failed" %
+                (len(failures), len(combinations)))
+
+    def make_build_task(self, name, cmd, log_path, failures):
+        def build():
+            # A failed build must not keep the other ones from finishing,
+            # so failures are collected instead of raised
+            try:
+                with build_stats.phase(name):
+                    f = open(log_path, "w")
+                    try:
+                        try:
+                            retcode = subprocess.call(cmd, cwd=script_dir,
+                                stdout=f, stderr=subprocess.STDOUT)
+                        except OSError as e:
+                            f.write("Failed to run %s: %s\n" % (cmd[0], e))
+                            retcode = -1
+                    finally:
+                        f.close()
+                    if retcode != 0:
+                        raise DistutilsExecError("%s exited with code %d" %
+                            (name, retcode))
+            except DistutilsExecError:
+                failures.append((name, log_path))
+        return build
+
 class shiboken_build_ext(_build_ext):
 
     def __init__(self, *args, **kwargs):
@@ -264,8 +675,14 @@ class shiboken_build(_build):
         self.build_type = "Release"
         self.qtinfo = None
         self.build_tests = False
+        self.compiler_cache = None
+        self.patchelf_path = None
+        self.debug_dir = None
     
     def run(self):
+        find_build_tools()
+        prepare_sources()
+        
         platform_arch = platform.architecture()[0]
         log.info("Python architecture is %s" % platform_arch)
 
@@ -273,13 +690,202 @@ class shiboken_build(_build):
         if OPTION_RELWITHDEBINFO:
             build_type = 'RelWithDebInfo'
 
-        # Check env
+        if not OPTION_ONLYPACKAGE:
+            if OPTION_CMAKE is None or not os.path.exists(OPTION_CMAKE):
+                raise DistutilsSetupError(
+                    "Failed to find cmake."
+                    " Please specify the path to cmake with --cmake parameter.")
+
+        if OPTION_QMAKE is None or not os.path.exists(OPTION_QMAKE):
+            raise DistutilsSetupError(
+                "Failed to find qmake."
+                " Please specify the path to qmake with --qmake parameter.")
+        
+        toolchain = self.get_toolchain(platform_arch, build_type)
+        make_path = toolchain["make_path"]
+        make_generator = toolchain["make_generator"]
+        py_executable = toolchain["py_executable"]
+        py_version = toolchain["py_version"]
+        py_include_dir = toolchain["py_include_dir"]
+        py_libdir = toolchain["py_libdir"]
+        py_prefix = toolchain["py_prefix"]
+        py_scripts_dir = toolchain["py_scripts_dir"]
+        py_library = toolchain["py_library"]
+        if py_library.endswith('.a'):
+            # Python was compiled as a static library
+            log.error("Failed to locate a dynamic Python library, using %s"
+                      % py_library)
+
+        script_dir = os.getcwd()
+
+        # The qmake properties are cached per qmake binary, so repeated
+        # runs don't have to query the Qt toolchain again
+        qtinfo = QtInfo(OPTION_QMAKE,
+            cache_file=os.path.join(script_dir, "shiboken_build", "qtinfo.json"))
+        qt_dir = os.path.dirname(OPTION_QMAKE)
+        qt_version = qtinfo.version
+        if not qt_version:
+            log.error("Failed to query the Qt version with qmake %s" % qtinfo.qmake_path)
+            sys.exit(1)
+        
+        # Update the PATH environment variable
+        update_env_path([py_scripts_dir, qt_dir])
+        
+        build_name = "py%s-qt%s-%s-%s" % \
+            (py_version, qt_version, platform.architecture()[0], build_type.lower())
+        
+        sources_dir = os.path.join(script_dir, "sources")
+        build_dir = os.path.join(script_dir, "shiboken_build", "%s" % build_name)
+        install_dir = os.path.join(script_dir, "shiboken_install", "%s" % build_name)
+        
+        # Try to ensure that tools built by this script (such as shiboken)
+        # are found before any that may already be installed on the system.
+        update_env_path([os.path.join(install_dir, 'bin')])
+        
+        # Tell cmake to look here for *.cmake files 
+        os.environ['CMAKE_PREFIX_PATH'] = install_dir
+        
+        compiler_cache = None
+        if not OPTION_ONLYPACKAGE:
+            compiler_cache = find_compiler_cache(OPTION_COMPILER_CACHE)
+            if compiler_cache is not None:
+                init_compiler_cache_env(compiler_cache,
+                    OPTION_COMPILER_CACHE_DIR, script_dir)
+        
+        artifact_cache = None
+        if OPTION_ARTIFACT_CACHE and not OPTION_ONLYPACKAGE:
+            max_size = DEFAULT_MAX_SIZE
+            if OPTION_ARTIFACT_CACHE_SIZE:
+                max_size = parse_size(OPTION_ARTIFACT_CACHE_SIZE)
+            artifact_cache = open_artifact_cache(OPTION_ARTIFACT_CACHE, max_size)
+        
+        self.make_path = make_path
+        self.make_generator = make_generator
+        self.build_name = build_name
+        self.debug = OPTION_DEBUG
+        self.script_dir = script_dir
+        self.sources_dir = sources_dir
+        self.build_dir = build_dir
+        self.install_dir = install_dir
+        self.qmake_path = OPTION_QMAKE
+        self.py_executable = py_executable
+        self.py_include_dir = py_include_dir
+        self.py_library = py_library
+        self.py_version = py_version
+        self.build_type = build_type
+        self.qtinfo = qtinfo
+        self.site_packages_dir = get_python_lib(1, 0, prefix=install_dir)
+        self.build_tests = OPTION_BUILDTESTS
+        self.compiler_cache = compiler_cache
+        self.artifact_cache = artifact_cache
+        self.debug_dir = os.path.join(script_dir, "shiboken_install",
+            "%s-debug" % build_name)
+        self.log_dir = os.path.join(script_dir, "shiboken_install",
+            "%s-logs" % build_name)
+        
+        build_stats.set_report_path(
+            os.path.join(script_dir, "shiboken_install", "%s-timings.json" % build_name),
+            build_name=build_name, version=__version__)
+        build_stats.set_status_path(
+            os.path.join(script_dir, "shiboken_install", "%s-status.json" % build_name))
+        if OPTION_MONITOR_INTERVAL:
+            try:
+                interval = float(OPTION_MONITOR_INTERVAL)
+            except ValueError:
+                interval = 0
+            if interval <= 0:
+                raise DistutilsOptionError("Invalid monitor interval %s, "
+                    "expected a number of seconds" % OPTION_MONITOR_INTERVAL)
+        
+        log.info("=" * 30)
+        log.info("Package version: %s" % __version__)
+        log.info("Build type: %s" % self.build_type)
+        log.info("Build tests: %s" % self.build_tests)
+        log.info("Incremental build: %s" % OPTION_INCREMENTAL)
+        log.info("Split debug info: %s" % OPTION_SPLIT_DEBUG)
+        log.info("Resource sampling interval: %s" % OPTION_MONITOR_INTERVAL)
+        log.info("-" * 3)
+        log.info("Make path: %s" % self.make_path)
+        log.info("Make generator: %s" % self.make_generator)
+        log.info("Make jobs: %s" % OPTION_JOBS)
+        log.info("Compiler cache: %s" % (compiler_cache and compiler_cache[1]))
+        log.info("Artifact cache: %s" % (artifact_cache and artifact_cache.root))
+        log.info("-" * 3)
+        log.info("Script directory: %s" % self.script_dir)
+        log.info("Sources directory: %s" % self.sources_dir)
+        log.info("Build directory: %s" % self.build_dir)
+        log.info("Install directory: %s" % self.install_dir)
+        log.info("Log directory: %s" % self.log_dir)
+        log.info("Python site-packages install directory: %s" % self.site_packages_dir)
+        log.info("-" * 3)
+        log.info("Python executable: %s" % self.py_executable)
+        log.info("Python includes: %s" % self.py_include_dir)
+        log.info("Python library: %s" % self.py_library)
+        log.info("Python prefix: %s" % py_prefix)
+        log.info("Python scripts: %s" % py_scripts_dir)
+        log.info("-" * 3)
+        log.info("Qt qmake: %s" % self.qmake_path)
+        log.info("Qt version: %s" % qtinfo.version)
+        log.info("Qt bins: %s" % qtinfo.bins_dir)
+        log.info("Qt plugins: %s" % qtinfo.plugins_dir)
+        log.info("=" * 30)
+        
+        # Prepare folders
+        if not os.path.exists(self.sources_dir):
+            log.info("Creating sources folder %s..." % self.sources_dir)
+            os.makedirs(self.sources_dir)
+        if not os.path.exists(self.build_dir):
+            log.info("Creating build folder %s..." % self.build_dir)
+            os.makedirs(self.build_dir)
+        if not os.path.exists(self.install_dir):
+            log.info("Creating install folder %s..." % self.install_dir)
+            os.makedirs(self.install_dir)
+        # The logs of the previous build are replaced
+        if os.path.exists(self.log_dir):
+            rmtree(self.log_dir)
+        os.makedirs(self.log_dir)
+        
+        # The build phases form a dependency graph, so independent phases
+        # (e.g. patchelf and the extension modules) overlap
+        graph = TaskGraph()
+        
+        if not OPTION_ONLYPACKAGE:
+            # Build extensions
+            for ext in ['shiboken']:
+                self.add_extension_phases(graph, ext)
+
+        # Build patchelf if needed
+        self.add_phase(graph, "build_patchelf", None, self.build_patchelf)
+
+        # Prepare packages
+        if not OPTION_SKIP_PACKAGING:
+            self.add_phase(graph, "prepare_packages", graph.names(),
+                self.prepare_packages)
+        
+        if OPTION_MONITOR_INTERVAL:
+            build_stats.start_sampler(interval)
+        try:
+            graph.run()
+            
+            # Build packages
+            if not OPTION_SKIP_PACKAGING:
+                _build.run(self)
+        finally:
+            build_stats.stop_sampler()
+        
+        build_stats.log_summary()
+
+    def probe_toolchain(self, platform_arch, build_type):
+        """Find the make tool and the Python executable, headers and library"""
         make_path = None
         make_generator = None
         if not OPTION_ONLYPACKAGE:
             if OPTION_MAKESPEC == "make":
                 make_name = "make"
                 make_generator = "Unix Makefiles"
+            elif OPTION_MAKESPEC == "ninja":
+                make_name = "ninja"
+                make_generator = "Ninja"
             elif OPTION_MAKESPEC == "msvc":
                 nmake_path = find_executable("nmake")
                 if nmake_path is None or not os.path.exists(nmake_path):
@@ -305,16 +911,6 @@ class shiboken_build(_build):
                     "You need the program \"%s\" on your system path to compile Shiboken." \
                     % make_name)
 
-            if OPTION_CMAKE is None or not os.path.exists(OPTION_CMAKE):
-                raise DistutilsSetupError(
-                    "Failed to find cmake."
-                    " Please specify the path to cmake with --cmake parameter.")
-
-        if OPTION_QMAKE is None or not os.path.exists(OPTION_QMAKE):
-            raise DistutilsSetupError(
-                "Failed to find qmake."
-                " Please specify the path to qmake with --qmake parameter.")
-        
         # Prepare parameters
         py_executable = sys.executable
         py_version = "%s.%s" % (sys.version_info[0], sys.version_info[1])
@@ -392,135 +988,234 @@ class shiboken_build(_build):
                     raise DistutilsSetupError(
                         "Failed to locate the Python library with %s" %
                         ', '.join(libs_tried))
-            if py_library.endswith('.a'):
-                # Python was compiled as a static library
-                log.error("Failed to locate a dynamic Python library, using %s"
-                          % py_library)
-
-        qtinfo = QtInfo(OPTION_QMAKE)
-        qt_dir = os.path.dirname(OPTION_QMAKE)
-        qt_version = qtinfo.version
-        if not qt_version:
-            log.error("Failed to query the Qt version with qmake %s" % qtinfo.qmake_path)
-            sys.exit(1)
-        
-        # Update the PATH environment variable
-        update_env_path([py_scripts_dir, qt_dir])
-        
-        build_name = "py%s-qt%s-%s-%s" % \
-            (py_version, qt_version, platform.architecture()[0], build_type.lower())
-        
-        script_dir = os.getcwd()
-        sources_dir = os.path.join(script_dir, "sources")
-        build_dir = os.path.join(script_dir, "shiboken_build", "%s" % build_name)
-        install_dir = os.path.join(script_dir, "shiboken_install", "%s" % build_name)
-        
-        # Try to ensure that tools built by this script (such as shiboken)
-        # are found before any that may already be installed on the system.
-        update_env_path([os.path.join(install_dir, 'bin')])
-        
-        # Tell cmake to look here for *.cmake files 
-        os.environ['CMAKE_PREFIX_PATH'] = install_dir
-        
-        self.make_path = make_path
-        self.make_generator = make_generator
-        self.debug = OPTION_DEBUG
-        self.script_dir = script_dir
-        self.sources_dir = sources_dir
-        self.build_dir = build_dir
-        self.install_dir = install_dir
-        self.qmake_path = OPTION_QMAKE
-        self.py_executable = py_executable
-        self.py_include_dir = py_include_dir
-        self.py_library = py_library
-        self.py_version = py_version
-        self.build_type = build_type
-        self.qtinfo = qtinfo
-        self.site_packages_dir = get_python_lib(1, 0, prefix=install_dir)
-        self.build_tests = OPTION_BUILDTESTS
-        
-        log.info("=" * 30)
-        log.info("Package version: %s" % __version__)
-        log.info("Build type: %s" % self.build_type)
-        log.info("Build tests: %s" % self.build_tests)
-        log.info("-" * 3)
-        log.info("Make path: %s" % self.make_path)
-        log.info("Make generator: %s" % self.make_generator)
-        log.info("Make jobs: %s" % OPTION_JOBS)
-        log.info("-" * 3)
-        log.info("Script directory: %s" % self.script_dir)
-        log.info("Sources directory: %s" % self.sources_dir)
-        log.info("Build directory: %s" % self.build_dir)
-        log.info("Install directory: %s" % self.install_dir)
-        log.info("Python site-packages install directory: %s" % self.site_packages_dir)
-        log.info("-" * 3)
-        log.info("Python executable: %s" % self.py_executable)
-        log.info("Python includes: %s" % self.py_include_dir)
-        log.info("Python library: %s" % self.py_library)
-        log.info("Python prefix: %s" % py_prefix)
-        log.info("Python scripts: %s" % py_scripts_dir)
-        log.info("-" * 3)
-        log.info("Qt qmake: %s" % self.qmake_path)
-        log.info("Qt version: %s" % qtinfo.version)
-        log.info("Qt bins: %s" % qtinfo.bins_dir)
-        log.info("Qt plugins: %s" % qtinfo.plugins_dir)
-        log.info("=" * 30)
-        
-        # Prepare folders
-        if not os.path.exists(self.sources_dir):
-            log.info("Creating sources folder %s..." % self.sources_dir)
-            os.makedirs(self.sources_dir)
-        if not os.path.exists(self.build_dir):
-            log.info("Creating build folder %s..." % self.build_dir)
-            os.makedirs(self.build_dir)
-        if not os.path.exists(self.install_dir):
-            log.info("Creating install folder %s..." % self.install_dir)
-            os.makedirs(self.install_dir)
-        
-        if not OPTION_ONLYPACKAGE:
-            # Build extensions
-            for ext in ['shiboken']:
-                self.build_extension(ext)
 
-        # Build patchelf if needed
-        self.build_patchelf()
+        return {
+            "make_path": make_path,
+            "make_generator": make_generator,
+            "py_executable": py_executable,
+            "py_version": py_version,
+            "py_include_dir": py_include_dir,
+            "py_libdir": py_libdir,
+            "py_prefix": py_prefix,
+            "py_scripts_dir": py_scripts_dir,
+            "py_library": py_library,
+        }
 
-        # Prepare packages
-        self.prepare_packages()
-        
-        # Build packages
-        _build.run(self)
+    def get_toolchain(self, platform_arch, build_type):
+        """Return the result of probe_toolchain(), from the cache in
+        shiboken_build when nothing it depends on changed"""
+        if OPTION_MAKESPEC == "msvc":
+            # Probing also sets up the MSVC environment, it can't be skipped
+            return self.probe_toolchain(platform_arch, build_type)
+        cache_path = os.path.join(script_dir, "shiboken_build", "toolchain.json")
+        key = fingerprint([
+            sys.executable,
+            sys.version,
+            getattr(sys, "abiflags", None),
+            sys.prefix,
+            platform_arch,
+            build_type,
+            OPTION_MAKESPEC,
+            OPTION_JOM,
+            OPTION_ONLYPACKAGE,
+            os.environ.get("PATH"),
+            [get_config_var(name) for name in
+                ["INCLUDEPY", "LIBDIR", "prefix", "MULTIARCH"]],
+        ])
+        cache = read_json_file(cache_path) or {}
+        entry = cache.get(key)
+        if entry:
+            # The binaries may have been replaced since
+            files = [get_file_identity(path) for path, identity in entry["files"]]
+            if files == [identity for path, identity in entry["files"]]:
+                log.info("Toolchain cache hit (%s)" % cache_path)
+                return entry["toolchain"]
+        log.info("Toolchain cache miss, probing the toolchain...")
+        toolchain = self.probe_toolchain(platform_arch, build_type)
+        paths = [toolchain["make_path"], toolchain["py_library"],
+            toolchain["py_include_dir"], OPTION_CMAKE, OPTION_QMAKE]
+        cache[key] = {
+            "toolchain": toolchain,
+            "files": [[path, get_file_identity(path)] for path in paths],
+        }
+        try:
+            write_json_file(cache_path, cache)
+        except (IOError, OSError):
+            # The next build probes the toolchain again
+            pass
+        return toolchain
 
     def build_patchelf(self):
         if not sys.platform.startswith('linux'):
             return
-        log.info("Building patchelf...")
         module_src_dir = os.path.join(self.sources_dir, "patchelf")
-        build_cmd = [
-            "g++",
+        # CXX may hold a compiler launcher or flags, e.g. "ccache g++"
+        compiler = shlex.split(os.environ.get("CXX", "g++"))
+        build_flags = ["-O2"]
+        
+        # Reuse the binary built from the same sources with the same compiler
+        compiler_version = get_process_output(compiler + ["--version"])
+        if compiler_version is None:
+            raise DistutilsSetupError("Failed to run the compiler %s" %
+                " ".join(compiler))
+        key = fingerprint([
+            hash_file(os.path.join(module_src_dir, "patchelf.cc")),
+            hash_file(os.path.join(module_src_dir, "elf.h")),
+            compiler,
+            compiler_version,
+            build_flags,
+        ])
+        patchelf_dir = os.path.join(self.script_dir, "shiboken_build", "patchelf", key)
+        self.patchelf_path = os.path.join(patchelf_dir, "patchelf")
+        if os.path.exists(self.patchelf_path):
+            log.info("Using cached patchelf %s" % self.patchelf_path)
+            return
+        
+        log.info("Building patchelf...")
+        if not os.path.exists(patchelf_dir):
+            os.makedirs(patchelf_dir)
+        # Build under a private name, so concurrent builds never see
+        # a partially written binary
+        tmp_path = "%s.%s.tmp" % (self.patchelf_path, os.getpid())
+        build_cmd = compiler + build_flags + [
             "%s/patchelf.cc" % (module_src_dir),
             "-o",
-            "patchelf",
+            tmp_path,
         ]
-        if run_process(build_cmd) != 0:
-            raise DistutilsSetupError("Error building patchelf")
+        try:
+            if run_process(build_cmd, cwd=patchelf_dir,
+                log_path=self.get_log_path("patchelf"),
+                monitor=build_stats.monitor("build_patchelf")) != 0:
+                raise DistutilsSetupError("Error building patchelf")
+            os.rename(tmp_path, self.patchelf_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
-    def build_extension(self, extension):
-        log.info("Building module %s..." % extension)
-        
-        # Prepare folders
-        os.chdir(self.build_dir)
-        module_build_dir = os.path.join(self.build_dir,  extension)
-        if os.path.exists(module_build_dir):
-            log.info("Deleting module build folder %s..." % module_build_dir)
-            rmtree(module_build_dir)
-        log.info("Creating module build folder %s..." % module_build_dir)
-        os.makedirs(module_build_dir)
-        os.chdir(module_build_dir)
-        
+    def get_log_path(self, name):
+        """Return the log file of the external commands of a build phase"""
+        return os.path.join(self.log_dir, name.replace(" ", "-") + ".log")
+
+    def add_phase(self, graph, name, deps, func, *args):
+        def run_phase():
+            with build_stats.phase(name):
+                func(*args)
+        graph.add(name, run_phase, deps)
+
+    def add_extension_phases(self, graph, extension):
+        artifact_key = None
+        if self.artifact_cache is not None:
+            artifact_key = self.get_artifact_key(extension)
+            if self.artifact_cache.contains(artifact_key):
+                log.info("Artifact cache hit for module %s (%s)" %
+                    (extension, artifact_key))
+                self.add_phase(graph, "%s restore" % extension, None,
+                    self.restore_extension, extension, artifact_key)
+                return
+            log.info("Artifact cache miss for module %s (%s)" %
+                (extension, artifact_key))
+        configure = "%s configure" % extension
+        make = "%s make" % extension
+        doc = "%s make doc" % extension
+        install = "%s make install" % extension
+        self.add_phase(graph, configure, None,
+            self.configure_extension, extension)
+        self.add_phase(graph, make, [configure],
+            self.compile_extension, extension)
+        # The docs are generated in a build folder of their own, two make or
+        # ninja processes in the module build folder would race on its build
+        # system files. Installing doesn't wait for them.
+        self.add_phase(graph, doc, [make],
+            self.build_extension_docs, extension)
+        self.add_phase(graph, install, [make],
+            self.install_extension, extension)
+        if artifact_key is not None:
+            self.add_phase(graph, "%s store" % extension, [install, doc],
+                self.store_extension, extension, artifact_key)
+
+    def get_module_build_dir(self, extension):
+        return os.path.join(self.build_dir,  extension)
+
+    def get_doc_build_dir(self, extension):
+        return os.path.join(self.build_dir, "%s-doc" % extension)
+
+    def get_artifact_dirs(self, extension):
+        return {
+            "install": self.install_dir,
+            "doc": os.path.join(self.get_doc_build_dir(extension), "doc", "html"),
+        }
+
+    def get_restored_marker(self, extension):
+        return os.path.join(self.build_dir, ".%s-restored" % extension)
+
+    def get_sources_revision(self, extension):
+        """Identify the sources of a module, by the submodule commit when
+        the checkout is clean and by their content otherwise"""
+        module_src_dir = os.path.join(self.sources_dir, extension)
+        commit = git_output(["rev-parse", "HEAD"], cwd=module_src_dir)
+        if commit is not None and git_output(["status", "--porcelain"],
+            cwd=module_src_dir) == "":
+            return commit
+        log.info("Sources of %s are not a clean git checkout, hashing them..." %
+            extension)
+        hashes = []
+        for root, dirnames, filenames in os.walk(module_src_dir):
+            if ".git" in dirnames:
+                dirnames.remove(".git")
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(root, filename)
+                hashes.append([os.path.relpath(path, module_src_dir),
+                    hash_file(path)])
+        return fingerprint(hashes)
+
+    def get_artifact_key(self, extension):
+        # The cmake arguments keep the absolute install prefix: the
+        # installed cmake files and rpaths refer to it, so a tree is only
+        # valid in the checkout that built it. The compiler launcher
+        # doesn't change the build output.
+        cmake_cmd = [arg for arg in self.get_cmake_cmd(extension)
+            if not "_COMPILER_LAUNCHER=" in arg]
+        return fingerprint([
+            self.get_sources_revision(extension),
+            cmake_cmd,
+            self.py_version,
+            get_abi_tag(),
+            self.qtinfo.version,
+            get_compiler_identity(),
+            self.build_type,
+            sys.platform,
+        ])
+
+    def restore_extension(self, extension, artifact_key):
+        log.info("Restoring module %s from the artifact cache..." % extension)
+        if self.artifact_cache.fetch(artifact_key,
+            self.get_artifact_dirs(extension)):
+            makefile(self.get_restored_marker(extension), content=artifact_key)
+            return
+        log.warn("Failed to restore module %s, building it" % extension)
+        # The commands are accounted to the restore phase, the only one
+        # the build stats know about
+        phase = "%s restore" % extension
+        self.configure_extension(extension, phase)
+        self.compile_extension(extension, phase)
+        self.build_extension_docs(extension, phase)
+        self.install_extension(extension, phase)
+        self.store_extension(extension, artifact_key)
+
+    def store_extension(self, extension, artifact_key):
+        log.info("Storing module %s in the artifact cache..." % extension)
+        try:
+            self.artifact_cache.store(artifact_key,
+                self.get_artifact_dirs(extension))
+        except (IOError, OSError):
+            # The module is installed already, only the next build loses
+            # the restore
+            log.warn("Failed to store module %s in the artifact cache: %s" %
+                (extension, sys.exc_info()[1]))
+
+    def get_cmake_cmd(self, extension):
         module_src_dir = os.path.join(self.sources_dir, extension)
-        
-        # Build module
         cmake_cmd = [
             OPTION_CMAKE,
             "-G", self.make_generator,
@@ -549,6 +1244,9 @@ class shiboken_build(_build):
             cmake_cmd.append("-DCMAKE_DEBUG_POSTFIX=_d")
 
         cmake_cmd.append("-DCMAKE_INSTALL_RPATH_USE_LINK_PATH=yes")
+        if self.compiler_cache is not None:
+            cmake_cmd.append("-DCMAKE_C_COMPILER_LAUNCHER=%s" % self.compiler_cache[1])
+            cmake_cmd.append("-DCMAKE_CXX_COMPILER_LAUNCHER=%s" % self.compiler_cache[1])
         if sys.version_info[0] > 2:
             cmake_cmd.append("-DUSE_PYTHON3=ON")
         
@@ -558,30 +1256,141 @@ class shiboken_build(_build):
             if OPTION_OSXARCH:
                 # also tell cmake which architecture to use 
                 cmake_cmd.append("-DCMAKE_OSX_ARCHITECTURES:STRING={}".format(OPTION_OSXARCH))
+        return cmake_cmd
+
+    def configure_extension(self, extension, phase=None):
+        log.info("Building module %s..." % extension)
+        
+        # Trees restored from the artifact cache share their files with the
+        # store, so the build must never write to them
+        restored_marker = self.get_restored_marker(extension)
+        if os.path.exists(restored_marker):
+            for artifact_dir in self.get_artifact_dirs(extension).values():
+                if os.path.exists(artifact_dir):
+                    log.info("Deleting restored folder %s..." % artifact_dir)
+                    rmtree(artifact_dir)
+            os.remove(restored_marker)
+
+        self.configure_build_dir(extension, self.get_module_build_dir(extension),
+            "%s configure" % extension, phase)
 
+    def configure_build_dir(self, extension, module_build_dir, name, phase=None):
+        module_src_dir = os.path.join(self.sources_dir, extension)
+        cmake_cmd = self.get_cmake_cmd(extension)
+
+        # Everything that makes an existing build tree unusable for
+        # an incremental rebuild
+        build_fingerprint = fingerprint([
+            cmake_cmd,
+            self.py_executable,
+            self.py_version,
+            self.qtinfo.version,
+            get_compiler_identity(),
+        ])
+        fingerprint_path = os.path.join(module_build_dir, ".setup-fingerprint")
+        
+        # Prepare folders
+        if OPTION_INCREMENTAL and \
+            read_fingerprint(fingerprint_path) == build_fingerprint:
+            log.info("Reusing module build folder %s..." % module_build_dir)
+        else:
+            if os.path.exists(module_build_dir):
+                log.info("Deleting module build folder %s..." % module_build_dir)
+                rmtree(module_build_dir)
+            log.info("Creating module build folder %s..." % module_build_dir)
+            os.makedirs(module_build_dir)
+        
         log.info("Configuring module %s (%s)..." % (extension,  module_src_dir))
-        if run_process(cmake_cmd) != 0:
+        if run_process(cmake_cmd, cwd=module_build_dir,
+            log_path=self.get_log_path(name),
+            monitor=build_stats.monitor(phase or name)) != 0:
             raise DistutilsSetupError("Error configuring " + extension)
-        
+        write_fingerprint(fingerprint_path, build_fingerprint)
+
+    def compile_extension(self, extension, phase=None):
         log.info("Compiling module %s..." % extension)
+        cache_stats = None
+        if self.compiler_cache is not None:
+            cache_stats = get_compiler_cache_stats(self.compiler_cache)
         cmd_make = [self.make_path]
         if OPTION_JOBS:
             cmd_make.append(OPTION_JOBS)
-        if run_process(cmd_make) != 0:
+        if run_process(cmd_make, cwd=self.get_module_build_dir(extension),
+            log_path=self.get_log_path("%s make" % extension),
+            progress=build_stats.progress(phase or "%s make" % extension),
+            monitor=build_stats.monitor(phase or "%s make" % extension)) != 0:
             raise DistutilsSetupError("Error compiling " + extension)
-        
+        if cache_stats is not None:
+            self.log_compiler_cache_stats(extension, cache_stats)
+
+    def build_extension_docs(self, extension, phase=None):
         log.info("Generating Shiboken documentation %s..." % extension)
-        if run_process([self.make_path, "doc"]) != 0:
+        doc_build_dir = self.get_doc_build_dir(extension)
+        self.configure_build_dir(extension, doc_build_dir,
+            "%s doc configure" % extension, phase or "%s make doc" % extension)
+        if run_process([self.make_path, "doc"], cwd=doc_build_dir,
+            log_path=self.get_log_path("%s make doc" % extension),
+            monitor=build_stats.monitor(phase or "%s make doc" % extension)) != 0:
             raise DistutilsSetupError("Error generating documentation " + extension)
-        
+
+    def install_extension(self, extension, phase=None):
         log.info("Installing module %s..." % extension)
-        if run_process([self.make_path, "install/fast"]) != 0:
+        # Ninja has no install/fast target, but its install target
+        # only checks that everything is up to date before installing
+        install_target = "install/fast"
+        if OPTION_MAKESPEC == "ninja":
+            install_target = "install"
+        if run_process([self.make_path, install_target],
+            cwd=self.get_module_build_dir(extension),
+            log_path=self.get_log_path("%s make install" % extension),
+            monitor=build_stats.monitor(phase or "%s make install" % extension)) != 0:
             raise DistutilsSetupError("Error pseudo installing " + extension)
-        
-        os.chdir(self.script_dir)
+
+    def log_compiler_cache_stats(self, extension, stats_before):
+        stats_after = get_compiler_cache_stats(self.compiler_cache)
+        if stats_after is None:
+            return
+        # The counters are global to the cache, so report the difference.
+        # Other builds using the same cache at the same time, e.g. the
+        # build_matrix ones, are counted as well.
+        hits = stats_after[0] - stats_before[0]
+        misses = stats_after[1] - stats_before[1]
+        total = hits + misses
+        hit_rate = total and 100.0 * hits / total or 0.0
+        log.info("Compiler cache (%s) for module %s: %d hits, %d misses (%.1f%% hit rate)" %
+            (self.compiler_cache[0], extension, hits, misses, hit_rate))
+        build_stats.set_info("compiler_cache", {
+            "tool": self.compiler_cache[0],
+            "module": extension,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hit_rate,
+        })
+
+    def prune_package_dirs(self):
+        """Remove the package folders kept by --incremental when they were
+        made by a build of another Python, Qt or build type, so that its
+        binaries are not packaged again"""
+        package_fingerprint = fingerprint([
+            self.build_name,
+            __version__,
+            OPTION_STANDALONE,
+            OPTION_SPLIT_DEBUG,
+        ])
+        fingerprint_path = os.path.join(self.script_dir, "shiboken_build",
+            "package-fingerprint")
+        if read_fingerprint(fingerprint_path) != package_fingerprint:
+            for n in ["shiboken_package", "build"]:
+                d = os.path.join(self.script_dir, n)
+                if os.path.isdir(d):
+                    log.info("Removing %s made by another build" % d)
+                    rmtree(d)
+            prepare_package_dirs()
+        write_fingerprint(fingerprint_path, package_fingerprint)
 
     def prepare_packages(self):
         log.info("Preparing packages...")
+        self.prune_package_dirs()
         version_str = "%sqt%s%s" % (__version__, self.qtinfo.version.replace(".", "")[0:3],
             self.debug and "dbg" or "")
         vars = {
@@ -599,6 +1408,7 @@ class shiboken_build(_build):
             "qt_imports_dir": self.qtinfo.imports_dir,
             "qt_translations_dir": self.qtinfo.translations_dir,
             "version": version_str,
+            "patchelf_path": self.patchelf_path,
         }
         os.chdir(self.script_dir)
         if sys.platform == "win32":
@@ -610,7 +1420,7 @@ class shiboken_build(_build):
         if sys.platform.startswith('linux'):
             # patchelf -> Shiboken/patchelf
             copyfile(
-                "{script_dir}/patchelf",
+                "{patchelf_path}",
                 "{dist_dir}/Shiboken/patchelf",
                 vars=vars)
             so_ext = '.so'
@@ -622,9 +1432,9 @@ class shiboken_build(_build):
             "{dist_dir}/Shiboken/__init__.py",
             content="__all__ = ['shiboken']",
             vars=vars)
-        # <build>/shiboken/doc/html/* -> <setup>/Shiboken/docs/shiboken
+        # <build>/shiboken-doc/doc/html/* -> <setup>/Shiboken/docs/shiboken
         copydir(
-            "{build_dir}/shiboken/doc/html",
+            "{build_dir}/shiboken-doc/doc/html",
             "{dist_dir}/Shiboken/docs/shiboken",
             force=False, vars=vars)
         # <install>/lib/site-packages/shiboken.so -> <setup>/Shiboken/shiboken.so
@@ -657,12 +1467,66 @@ class shiboken_build(_build):
         if OPTION_STANDALONE:
             if sys.platform == 'darwin':
                 raise RuntimeError('--standalone not yet supported for OSX')
-            # <qt>/lib/* -> <setup>/Shiboken
-            copydir("{qt_lib_dir}", "{dist_dir}/Shiboken",
-                filter=[
-                    "libQtCore*.so.?", "libQtXml*.so.?",
-                ],
-                recursive=False, vars=vars)
+            # <qt>/lib/* -> <setup>/Shiboken, only the libraries that
+            # the package loads, directly or through each other
+            pkg_dir = "{dist_dir}/Shiboken".format(**vars)
+            binaries = self.get_package_binaries(pkg_dir, so_star)
+            for name, lib_path in get_needed_closure(binaries, [vars["qt_lib_dir"]]):
+                copyfile(lib_path, os.path.join(pkg_dir, name))
+        if OPTION_SPLIT_DEBUG:
+            if not sys.platform.startswith('linux'):
+                log.warn("--split-debug is only supported on Linux, keeping "
+                    "the debug info")
+            else:
+                self.split_debug_info(self.get_package_binaries(
+                    "{dist_dir}/Shiboken".format(**vars), so_star))
+
+    def get_package_binaries(self, pkg_dir, so_star):
+        return [os.path.join(pkg_dir, name)
+            for name in sorted(os.listdir(pkg_dir))
+            if name in ("shiboken.so", "shiboken") or
+                fnmatch.fnmatch(name, "libshiboken*" + so_star)]
+
+    def split_debug_info(self, binaries):
+        objcopy = os.environ.get("OBJCOPY") or find_executable("objcopy")
+        if not objcopy:
+            raise DistutilsSetupError("objcopy is required by --split-debug")
+        if os.path.exists(self.debug_dir):
+            rmtree(self.debug_dir)
+        split_log = self.get_log_path("split debug")
+        for binary in binaries:
+            # Use the layout of /usr/lib/debug, so that debuggers find the
+            # debug info by build id once the folder is added to their
+            # debug file directories
+            build_id = get_elf_build_id(binary)
+            if build_id:
+                debug_file = os.path.join(self.debug_dir, ".build-id",
+                    build_id[:2], build_id[2:] + ".debug")
+            else:
+                debug_file = os.path.join(self.debug_dir,
+                    os.path.basename(binary) + ".debug")
+            debug_file_dir = os.path.dirname(debug_file)
+            if not os.path.exists(debug_file_dir):
+                os.makedirs(debug_file_dir)
+            # The versioned copies of a library share the debug file
+            if not os.path.exists(debug_file):
+                log.info("Moving the debug info of %s to %s" % (binary, debug_file))
+                if run_process([objcopy, "--only-keep-debug", binary, debug_file],
+                    log_path=split_log) != 0:
+                    raise DistutilsSetupError("Error extracting debug info of " + binary)
+            log.info("Stripping %s" % binary)
+            if run_process([objcopy, "--strip-unneeded",
+                "--add-gnu-debuglink=%s" % debug_file, binary],
+                log_path=split_log) != 0:
+                raise DistutilsSetupError("Error stripping " + binary)
+        if OPTION_DEBUG_ARCHIVE:
+            archive_path = self.debug_dir + ".tar.gz"
+            log.info("Creating debug info archive %s" % archive_path)
+            archive = tarfile.open(archive_path, "w:gz")
+            try:
+                archive.add(self.debug_dir, os.path.basename(self.debug_dir))
+            finally:
+                archive.close()
 
     def prepare_packages_win32(self, vars):
         makefile(
@@ -670,9 +1534,9 @@ class shiboken_build(_build):
             content="__all__ = ['shiboken']",
             vars=vars)
         pdbs = ['*.pdb'] if self.debug or self.build_type == 'RelWithDebInfo' else []       
-        # <build>/shiboken/doc/html/* -> <setup>/Shiboken/docs/shiboken
+        # <build>/shiboken-doc/doc/html/* -> <setup>/Shiboken/docs/shiboken
         copydir(
-            "{build_dir}/shiboken/doc/html",
+            "{build_dir}/shiboken-doc/doc/html",
             "{dist_dir}/Shiboken/docs/shiboken",
             force=False, vars=vars)
         # <install>/lib/site-packages/shiboken.pyd -> <setup>/Shiboken/shiboken.pyd
@@ -788,7 +1652,11 @@ setup(
         'build': shiboken_build,
         'build_ext': shiboken_build_ext,
         'bdist_egg': shiboken_bdist_egg,
+        'bdist_wheel': shiboken_bdist_wheel,
+        'build_matrix': shiboken_build_matrix,
         'develop': shiboken_develop,
+        'egg_info': shiboken_egg_info,
+        'sdist': shiboken_sdist,
         'install': shiboken_install,
     },
     
@@ -6,7 +6,9 @@
 import os, sys, traceback, shutil, fnmatch, stat
 from os.path import dirname, abspath
 from subprocess import Popen, PIPE
-import re
+import struct
+import json
+import hashlib
 
 
 try:
@@ -57,8 +59,8 @@ def back_tick(cmd, ret_err=False):
 
     Parameters
     ----------
-    cmd : str
-        command to execute
+    cmd : str or list of str
+        command to execute, through the shell if it is a string
     ret_err : bool, optional
         If True, return stderr in addition to stdout.  If False, just return
         stdout
@@ -75,8 +77,13 @@ def back_tick(cmd, ret_err=False):
     ------
     Raises RuntimeError if command returns non-zero exit code
     """
-    proc = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
+    shell = isinstance(cmd, str)
+    if not shell:
+        cmd = list(cmd)
+    proc = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=shell)
     out, err = proc.communicate()
+    if not shell:
+        cmd = ' '.join(cmd)
     if not isinstance(out, str):
         # python 3
         out = out.decode()
@@ -92,11 +99,125 @@ def back_tick(cmd, ret_err=False):
     return out, err.strip()
 
 
-OSX_OUTNAME_RE = re.compile(r'\(compatibility version [\d.]+, current version '
-                        '[\d.]+\)')
+MH_MAGIC = 0xfeedface
+MH_MAGIC_64 = 0xfeedfacf
+FAT_MAGIC = 0xcafebabe
+FAT_MAGIC_64 = 0xcafebabf
+LC_REQ_DYLD = 0x80000000
+LC_LOAD_DYLIB = 0xc
+LC_ID_DYLIB = 0xd
+LC_LOAD_WEAK_DYLIB = 0x18 | LC_REQ_DYLD
+LC_RPATH = 0x1c | LC_REQ_DYLD
+LC_REEXPORT_DYLIB = 0x1f | LC_REQ_DYLD
+LC_LAZY_LOAD_DYLIB = 0x20
+LC_LOAD_UPWARD_DYLIB = 0x23 | LC_REQ_DYLD
+OSX_DYLIB_COMMANDS = (LC_ID_DYLIB, LC_LOAD_DYLIB, LC_LOAD_WEAK_DYLIB,
+    LC_REEXPORT_DYLIB, LC_LAZY_LOAD_DYLIB, LC_LOAD_UPWARD_DYLIB)
+
+
+class MachOError(Exception):
+    pass
+
+
+class MachOFile(object):
+    """ Reader of the install names and rpaths of a Mach-O file
+
+    Reads the load commands directly, the same ones that ``otool -L`` and
+    ``otool -l`` print.  For universal (fat) files the values of all the
+    architectures are merged, in order.
+
+    Parameters
+    ----------
+    path : str
+        path to executable or library
+
+    Attributes
+    ----------
+    install_names : list of str
+        library id followed by the names of the libraries it loads
+    rpaths : list of str
+        LC_RPATH values
+    """
+    def __init__(self, path):
+        self.path = path
+        self.install_names = []
+        self.rpaths = []
+        f = open(path, 'rb')
+        try:
+            self._file = f
+            try:
+                self._parse()
+            except struct.error:
+                raise MachOError('%s: truncated Mach-O file' % path)
+        finally:
+            f.close()
+            self._file = None
+
+    def _read(self, offset, size):
+        self._file.seek(offset)
+        data = self._file.read(size)
+        if len(data) != size:
+            raise MachOError('%s: truncated Mach-O file' % self.path)
+        return data
+
+    def _parse(self):
+        magic, = struct.unpack('>I', self._read(0, 4))
+        if magic in (FAT_MAGIC, FAT_MAGIC_64):
+            nfat_arch, = struct.unpack('>I', self._read(4, 4))
+            if magic == FAT_MAGIC:
+                arch_fmt = '>IIIII'
+            else:
+                arch_fmt = '>IIQQII'
+            arch_size = struct.calcsize(arch_fmt)
+            for i in range(nfat_arch):
+                arch = struct.unpack(arch_fmt,
+                    self._read(8 + i * arch_size, arch_size))
+                self._parse_image(arch[2])
+        else:
+            self._parse_image(0)
+
+    def _parse_image(self, offset):
+        magic_data = self._read(offset, 4)
+        for endian in ('<', '>'):
+            magic, = struct.unpack(endian + 'I', magic_data)
+            if magic in (MH_MAGIC, MH_MAGIC_64):
+                break
+        else:
+            raise MachOError('%s: not a Mach-O file' % self.path)
+        header_size = magic == MH_MAGIC_64 and 32 or 28
+        (magic, cputype, cpusubtype, filetype, ncmds, sizeofcmds,
+            flags) = struct.unpack(endian + 'IiiIIII', self._read(offset, 28))
+        cmds = self._read(offset + header_size, sizeofcmds)
+        pos = 0
+        for i in range(ncmds):
+            cmd, cmdsize = struct.unpack(endian + 'II', cmds[pos:pos + 8])
+            if cmdsize < 8 or pos + cmdsize > len(cmds):
+                raise MachOError('%s: bad load command size' % self.path)
+            if cmd in OSX_DYLIB_COMMANDS:
+                self._add(self.install_names,
+                    self._get_string(cmds, pos, cmdsize, endian))
+            elif cmd == LC_RPATH:
+                self._add(self.rpaths,
+                    self._get_string(cmds, pos, cmdsize, endian))
+            pos += cmdsize
+
+    def _get_string(self, cmds, pos, cmdsize, endian):
+        # Both dylib_command and rpath_command start with the offset of
+        # the name within the command
+        name_offset, = struct.unpack(endian + 'I', cmds[pos + 8:pos + 12])
+        value = cmds[pos + name_offset:pos + cmdsize].split(b'\0', 1)[0]
+        if not isinstance(value, str):
+            # python 3
+            value = value.decode(sys.getfilesystemencoding())
+        return value
+
+    def _add(self, values, value):
+        if not value in values:
+            values.append(value)
+
 
 def osx_get_install_names(libpath):
-    """ Get OSX library install names from library `libpath` using ``otool``
+    """ Get OSX library install names from library `libpath`
 
     Parameters
     ----------
@@ -108,15 +229,11 @@ def osx_get_install_names(libpath):
     install_names : list of str
         install names in library `libpath`
     """
-    out = back_tick('otool -L ' + libpath)
-    libs = [line for line in out.split('\n')][1:]
-    return [OSX_OUTNAME_RE.sub('', lib).strip() for lib in libs]
+    return MachOFile(libpath).install_names
 
 
-OSX_RPATH_RE = re.compile(r"path (.+) \(offset \d+\)")
-
 def osx_get_rpaths(libpath):
-    """ Get rpaths from library `libpath` using ``otool``
+    """ Get rpaths from library `libpath`
 
     Parameters
     ----------
@@ -132,22 +249,7 @@ def osx_get_rpaths(libpath):
     -----
     See ``man dyld`` for more information on rpaths in libraries
     """
-    lines = back_tick('otool -l ' + libpath).split('\n')
-    ctr = 0
-    rpaths = []
-    while ctr < len(lines):
-        line = lines[ctr].strip()
-        if line != 'cmd LC_RPATH':
-            ctr += 1
-            continue
-        assert lines[ctr + 1].strip().startswith('cmdsize')
-        rpath_line = lines[ctr + 2].strip()
-        match = OSX_RPATH_RE.match(rpath_line)
-        if match is None:
-            raise RuntimeError('Unexpected path line: ' + rpath_line)
-        rpaths.append(match.groups()[0])
-        ctr += 3
-    return rpaths
+    return MachOFile(libpath).rpaths
 
 
 def localize_libpaths(libpath, local_libs, enc_path=None):
@@ -170,17 +272,407 @@ def localize_libpaths(libpath, local_libs, enc_path=None):
     """
     if enc_path is None:
         enc_path = abspath(dirname(libpath))
-    install_names = osx_get_install_names(libpath)
-    need_rpath = False
-    for install_name in install_names:
+    args = get_localize_args(MachOFile(libpath), enc_path)
+    if args:
+        back_tick(['install_name_tool'] + args + [libpath])
+
+
+def get_localize_args(macho, enc_path):
+    """ Return the ``install_name_tool`` arguments `localize_libpaths` needs
+
+    All the changes are collected for a single ``install_name_tool`` run.
+    An empty list means that `macho` is already localized.
+    """
+    args = []
+    for install_name in macho.install_names:
         if install_name[0] in '/@':
             continue
-        back_tick('install_name_tool -change %s @rpath/%s %s' %
-           (install_name, install_name, libpath))
-        need_rpath = True
-    if need_rpath and enc_path not in osx_get_rpaths(libpath):
-        back_tick('install_name_tool -add_rpath %s %s' %
-           (enc_path, libpath))
+        args += ['-change', install_name, '@rpath/' + install_name]
+    if args and enc_path not in macho.rpaths:
+        args += ['-add_rpath', enc_path]
+    return args
+
+
+ELF_MAGIC = b'\x7fELF'
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_NOTE = 4
+NT_GNU_BUILD_ID = 3
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_STRSZ = 10
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+
+class ElfError(Exception):
+    pass
+
+
+class ElfFile(object):
+    """ Reader and in-place writer of the ELF dynamic section
+
+    Handles 32 and 64-bit, little and big-endian files, the same ones as
+    ``ElfFile`` in ``patchelf.cc``.  Only the headers, the dynamic
+    section and the dynamic string table are read.
+
+    Parameters
+    ----------
+    path : str
+        path to executable or library
+    writable : bool, optional
+        If True, open the file for patching with ``set_rpath``
+    """
+    def __init__(self, path, writable=False):
+        self.path = path
+        self._file = open(path, writable and 'r+b' or 'rb')
+        try:
+            self._parse()
+        except (struct.error, IndexError):
+            self.close()
+            raise ElfError('%s: truncated ELF file' % path)
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def _read(self, offset, size):
+        self._file.seek(offset)
+        return self._file.read(size)
+
+    def _write(self, offset, data):
+        self._file.seek(offset)
+        self._file.write(data)
+
+    def _parse(self):
+        ident = self._read(0, 16)
+        if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+            raise ElfError('%s: not an ELF file' % self.path)
+        ei_class = ord(ident[4:5])
+        ei_data = ord(ident[5:6])
+        if ei_data == ELFDATA2LSB:
+            endian = '<'
+        elif ei_data == ELFDATA2MSB:
+            endian = '>'
+        else:
+            raise ElfError('%s: unknown ELF byte order' % self.path)
+        if ei_class == ELFCLASS32:
+            ehdr_fmt = endian + 'HHIIIIIHHHHHH'
+            phdr_fmt = endian + 'IIIIIIII'
+            self._dyn_fmt = endian + 'iI'
+        elif ei_class == ELFCLASS64:
+            ehdr_fmt = endian + 'HHIQQQIHHHHHH'
+            phdr_fmt = endian + 'IIQQQQQQ'
+            self._dyn_fmt = endian + 'qQ'
+        else:
+            raise ElfError('%s: unknown ELF class' % self.path)
+        self.is64 = ei_class == ELFCLASS64
+        self.little_endian = ei_data == ELFDATA2LSB
+
+        ehdr = struct.unpack(ehdr_fmt,
+            self._read(16, struct.calcsize(ehdr_fmt)))
+        e_phoff, e_phentsize, e_phnum = ehdr[4], ehdr[8], ehdr[9]
+
+        self._endian = endian
+
+        # Keep (type, offset, vaddr, filesz) of the program headers
+        self._segments = []
+        for i in range(e_phnum):
+            phdr = struct.unpack(phdr_fmt, self._read(e_phoff + i * e_phentsize,
+                struct.calcsize(phdr_fmt)))
+            if self.is64:
+                p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz = phdr[:6]
+            else:
+                p_type, p_offset, p_vaddr, p_paddr, p_filesz = phdr[:5]
+            self._segments.append((p_type, p_offset, p_vaddr, p_filesz))
+
+        # Keep (file offset, tag, value) of the dynamic entries
+        self._dynamic = []
+        self._dynstr_offset = None
+        self._dynstr = b''
+        dynamic = [seg for seg in self._segments if seg[0] == PT_DYNAMIC]
+        if not dynamic:
+            # Statically linked
+            return
+        dyn_size = struct.calcsize(self._dyn_fmt)
+        offset = dynamic[0][1]
+        data = self._read(offset, dynamic[0][3])
+        for pos in range(0, len(data) - dyn_size + 1, dyn_size):
+            tag, value = struct.unpack(self._dyn_fmt, data[pos:pos + dyn_size])
+            if tag == DT_NULL:
+                break
+            self._dynamic.append((offset + pos, tag, value))
+
+        strtab = self._get_dynamic_value(DT_STRTAB)
+        strsz = self._get_dynamic_value(DT_STRSZ)
+        if strtab is None or strsz is None:
+            raise ElfError('%s: no dynamic string table' % self.path)
+        self._dynstr_offset = self._vaddr_to_offset(strtab)
+        self._dynstr = self._read(self._dynstr_offset, strsz)
+
+    def _get_dynamic_value(self, tag):
+        for entry in self._dynamic:
+            if entry[1] == tag:
+                return entry[2]
+        return None
+
+    def _get_dynamic_entry(self, tag):
+        for entry in self._dynamic:
+            if entry[1] == tag:
+                return entry
+        return None
+
+    def _vaddr_to_offset(self, vaddr):
+        for p_type, p_offset, p_vaddr, p_filesz in self._segments:
+            if p_type == PT_LOAD and p_vaddr <= vaddr < p_vaddr + p_filesz:
+                return vaddr - p_vaddr + p_offset
+        raise ElfError('%s: address 0x%x is not mapped' % (self.path, vaddr))
+
+    def _get_bytes(self, index):
+        end = self._dynstr.find(b'\0', index)
+        if end == -1:
+            raise ElfError('%s: unterminated dynamic string' % self.path)
+        return self._dynstr[index:end]
+
+    def _get_string(self, index):
+        value = self._get_bytes(index)
+        if not isinstance(value, str):
+            # python 3
+            value = value.decode(sys.getfilesystemencoding())
+        return value
+
+    def get_needed(self):
+        """ Return the DT_NEEDED library names """
+        return [self._get_string(value) for offset, tag, value in self._dynamic
+            if tag == DT_NEEDED]
+
+    def get_build_id(self):
+        """ Return the GNU build id as a hex string, or None """
+        for p_type, p_offset, p_vaddr, p_filesz in self._segments:
+            if p_type != PT_NOTE:
+                continue
+            data = self._read(p_offset, p_filesz)
+            pos = 0
+            while pos + 12 <= len(data):
+                namesz, descsz, note_type = struct.unpack(self._endian + 'III',
+                    data[pos:pos + 12])
+                name_start = pos + 12
+                desc_start = name_start + ((namesz + 3) & ~3)
+                desc_end = desc_start + descsz
+                if note_type == NT_GNU_BUILD_ID and \
+                        data[name_start:name_start + namesz] == b'GNU\0':
+                    return ''.join(['%02x' % c for c in
+                        bytearray(data[desc_start:desc_end])])
+                pos = desc_start + ((descsz + 3) & ~3)
+        return None
+
+    def get_rpath(self):
+        """ Return the DT_RUNPATH, or the DT_RPATH when there is no
+        DT_RUNPATH (which the dynamic loader ignores then), or None """
+        entry = self._get_dynamic_entry(DT_RUNPATH) or \
+            self._get_dynamic_entry(DT_RPATH)
+        if entry is None:
+            return None
+        return self._get_string(entry[2])
+
+    def set_rpath(self, rpath):
+        """ Set the RPATH in place, the way ``patchelf --set-rpath`` does
+
+        A DT_RPATH is converted to DT_RUNPATH.  The new value must fit into
+        the string of the current one; growing the dynamic string table
+        needs the sections to be moved, which is left to patchelf.
+
+        Returns
+        -------
+        patched : bool
+            True if the file has the requested RPATH, False if it could not
+            be set in place.
+        """
+        runpath_entry = self._get_dynamic_entry(DT_RUNPATH)
+        rpath_entry = self._get_dynamic_entry(DT_RPATH)
+        entry = runpath_entry or rpath_entry
+        if entry is None:
+            # Adding a dynamic entry needs a bigger dynamic section
+            return False
+        new_value = rpath
+        if not isinstance(new_value, bytes):
+            new_value = new_value.encode(sys.getfilesystemencoding())
+        old_value = self._get_bytes(entry[2])
+        if old_value == new_value:
+            return True
+        if len(new_value) > len(old_value):
+            return False
+        if runpath_entry is None:
+            # Like patchelf, prefer the non-obsolete DT_RUNPATH
+            self._write(rpath_entry[0],
+                struct.pack(self._dyn_fmt, DT_RUNPATH, rpath_entry[2]))
+        # Like patchelf, blank out the remains of the old value
+        padding = len(old_value) - len(new_value)
+        if padding:
+            new_value += b'\0' + b'X' * (padding - 1)
+        self._write(self._dynstr_offset + entry[2], new_value)
+        self._file.flush()
+        return True
+
+
+def elf_set_rpath(libpath, rpath):
+    """ Set the RPATH of `libpath` in place
+
+    Returns
+    -------
+    patched : bool
+        False if the file is not a dynamic ELF file or needs to grow, which
+        is left to ``patchelf_set_rpath``.
+    """
+    try:
+        elf = ElfFile(libpath, writable=True)
+        try:
+            return elf.set_rpath(rpath)
+        finally:
+            elf.close()
+    except ElfError:
+        return False
+
+
+def patchelf_set_rpath(patchelf_path, rpath, libpaths):
+    """ Set the RPATH of all `libpaths` with a single ``patchelf`` run """
+    if not libpaths:
+        return
+    from distutils.spawn import spawn
+    spawn([patchelf_path, '--set-rpath', rpath] + list(libpaths),
+        search_path=False, verbose=1)
+
+
+# Upper bound of the threads patching libraries at the same time
+PATCH_WORKERS = 8
+
+# Manifest of the libraries patched by a previous run, in the package dir
+PATCH_STAMP_FILE = ".postinstall-stamp.json"
+
+
+def get_file_sha1(path):
+    sha1 = hashlib.sha1()
+    f = open(path, 'rb')
+    try:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            sha1.update(data)
+    finally:
+        f.close()
+    return sha1.hexdigest()
+
+
+def get_patch_stamp(libpath):
+    st = os.stat(libpath)
+    return {
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+        "sha1": get_file_sha1(libpath),
+    }
+
+
+def read_patch_stamps(stamp_path, rpath):
+    """ Return the stamps of the libraries patched to `rpath` by a previous
+    run, keyed by file name """
+    try:
+        f = open(stamp_path, 'r')
+        try:
+            manifest = json.load(f)
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(manifest, dict) or manifest.get("rpath") != rpath:
+        return {}
+    return manifest.get("files") or {}
+
+
+def write_patch_stamps(stamp_path, rpath, stamps):
+    # The manifest only saves work on the next run, so a read-only package
+    # dir is not an error
+    tmp_path = "%s.%s.tmp" % (stamp_path, os.getpid())
+    try:
+        f = open(tmp_path, 'w')
+        try:
+            json.dump({"rpath": rpath, "files": stamps}, f, indent=2,
+                sort_keys=True)
+        finally:
+            f.close()
+        os.rename(tmp_path, stamp_path)
+        file_created(stamp_path)
+    except (IOError, OSError):
+        if os.path.exists(tmp_path):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+def is_patch_stamp_current(stamp, libpath):
+    """ Check that `libpath` is unchanged since `stamp` was taken """
+    if not stamp:
+        return False
+    try:
+        st = os.stat(libpath)
+        if stamp.get("size") != st.st_size:
+            return False
+        if stamp.get("mtime") == st.st_mtime:
+            return True
+        # Same size, new time: compare the contents
+        return stamp.get("sha1") == get_file_sha1(libpath)
+    except (IOError, OSError):
+        return False
+
+
+def patch_libraries(rpath_cmd, shiboken_path, libpaths):
+    """ Run `rpath_cmd` for all `libpaths` on a pool of worker threads
+
+    Returns
+    -------
+    failures : list of tuple
+        ``(libpath, error message)`` of the libraries that could not be
+        patched
+    """
+    def patch(libpath):
+        try:
+            rpath_cmd(shiboken_path, libpath)
+        except Exception:
+            return libpath, str(sys.exc_info()[1])
+        return libpath, None
+
+    try:
+        import multiprocessing
+        workers = min(PATCH_WORKERS, multiprocessing.cpu_count(), len(libpaths))
+    except (ImportError, NotImplementedError):
+        workers = 1
+    if workers > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(patch, libpaths)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [patch(libpath) for libpath in libpaths]
+
+    return [(libpath, error) for libpath, error in results if error is not None]
 
 
 def install_posix():
@@ -197,11 +689,23 @@ def install_posix():
     if sys.platform.startswith('linux'):
         executables.append('patchelf')
         patchelf_path = os.path.join(shiboken_path, "patchelf")
-        from distutils.spawn import spawn
+
+        # Libraries whose RPATH does not fit in place
+        patchelf_libs = []
 
         def rpath_cmd(shiboken_path, srcpath):
-            cmd = [patchelf_path, '--set-rpath', shiboken_path, srcpath]
-            spawn(cmd, search_path=False, verbose=1)
+            if not elf_set_rpath(srcpath, shiboken_path):
+                patchelf_libs.append(srcpath)
+
+        def is_patched(shiboken_path, srcpath):
+            try:
+                elf = ElfFile(srcpath)
+                try:
+                    return elf.get_rpath() == shiboken_path
+                finally:
+                    elf.close()
+            except ElfError:
+                return False
 
         shiboken_libs = [lib for lib in os.listdir(shiboken_path) if filter_match(
                        lib, ["shiboken.so", "shiboken"])]
@@ -212,6 +716,12 @@ def install_posix():
         def rpath_cmd(shiboken_path, srcpath):
             localize_libpaths(srcpath, shiboken_libs, shiboken_path)
 
+        def is_patched(shiboken_path, srcpath):
+            try:
+                return not get_localize_args(MachOFile(srcpath), shiboken_path)
+            except MachOError:
+                return False
+
     else:
         raise RuntimeError('Not configured for platform ' +
                            sys.platform)
@@ -222,12 +732,55 @@ def install_posix():
         set_exec(execpath)
 
     # Update rpath in Shiboken libs
-    for srcname in shiboken_libs:
-        if os.path.isdir(srcname):
+    srcpaths = [os.path.join(shiboken_path, srcname)
+        for srcname in shiboken_libs]
+    srcpaths = [srcpath for srcpath in srcpaths if not os.path.isdir(srcpath)]
+    stamp_path = os.path.join(shiboken_path, PATCH_STAMP_FILE)
+    stamps = read_patch_stamps(stamp_path, shiboken_path)
+    unpatched = []
+    for srcpath in srcpaths:
+        srcname = os.path.basename(srcpath)
+        if is_patch_stamp_current(stamps.get(srcname), srcpath) or \
+                is_patched(shiboken_path, srcpath):
+            print("Rpath in %s is up to date." % srcpath)
+        else:
+            unpatched.append(srcpath)
+    failures = patch_libraries(rpath_cmd, shiboken_path, unpatched)
+    failed = set([srcpath for srcpath, error in failures])
+    if sys.platform.startswith('linux'):
+        try:
+            patchelf_set_rpath(patchelf_path, shiboken_path, patchelf_libs)
+        except Exception:
+            # patchelf goes on after a failing file, find out which ones
+            error = str(sys.exc_info()[1])
+            for srcpath in patchelf_libs:
+                if not is_patched(shiboken_path, srcpath):
+                    failures.append((srcpath, error))
+                    failed.add(srcpath)
+    # Only now the libraries left to patchelf are patched as well
+    for srcpath in unpatched:
+        if not srcpath in failed:
+            print("Patched rpath in %s to %s." % (srcpath, shiboken_path))
+    new_stamps = {}
+    for srcpath in srcpaths:
+        srcname = os.path.basename(srcpath)
+        if srcpath in failed:
             continue
-        srcpath = os.path.join(shiboken_path, srcname)
-        rpath_cmd(shiboken_path, srcpath)
-        print("Patched rpath in %s to %s." % (srcpath, shiboken_path))
+        stamp = stamps.get(srcname)
+        try:
+            st = os.stat(srcpath)
+            if srcpath in unpatched or not stamp or \
+                    stamp.get("mtime") != st.st_mtime:
+                stamp = get_patch_stamp(srcpath)
+            new_stamps[srcname] = stamp
+        except (IOError, OSError):
+            pass
+    if new_stamps != stamps:
+        write_patch_stamps(stamp_path, shiboken_path, new_stamps)
+    if failures:
+        for srcpath, error in failures:
+            print("Failed to patch rpath in %s: %s" % (srcpath, error))
+        raise RuntimeError("Failed to patch %d libraries" % len(failures))
 
     # Check Shiboken installation status
     try:
@@ -252,6 +805,20 @@ def install_win32():
     print("Shiboken package found in %s..." % shiboken_path)
 
 def uninstall():
+    # The patch manifest is not part of the installed files, remove it so
+    # that it doesn't keep the package folder around
+    try:
+        import Shiboken
+    except ImportError:
+        Shiboken = None
+    if Shiboken is not None:
+        stamp_path = os.path.join(
+            os.path.abspath(os.path.dirname(Shiboken.__file__)), PATCH_STAMP_FILE)
+        try:
+            os.remove(stamp_path)
+            print("Removed %s" % stamp_path)
+        except OSError:
+            pass
     print("The Shiboken extensions were successfully uninstalled.")
 
 def usage():
@@ -13,6 +13,7 @@
 
 #include <sys/types.h>
 #include <sys/stat.h>
+#include <sys/mman.h>
 #include <unistd.h>
 #include <fcntl.h>
 #include <limits.h>
@@ -34,13 +35,26 @@ static bool debugMode = false;
 
 static bool forceRPath = false;
 
+static bool batchMode = false;
+
 static string fileName;
 
 
-off_t fileSize, maxSize;
+off_t fileSize, maxSize, mappedSize;
 unsigned char * contents = 0;
 
 
+/* Thrown by error(), so that a batch can go on with the next file. */
+struct PatchelfError
+{
+    string msg;
+    PatchelfError(const string & msg) : msg(msg) { }
+};
+
+
+typedef vector<pair<off_t, size_t> > FileRanges;
+
+
 #define ElfFileParams class Elf_Ehdr, class Elf_Phdr, class Elf_Shdr, class Elf_Addr, class Elf_Off, class Elf_Dyn, class Elf_Sym
 #define ElfFileParamNames Elf_Ehdr, Elf_Phdr, Elf_Shdr, Elf_Addr, Elf_Off, Elf_Dyn, Elf_Sym
 
@@ -71,6 +85,14 @@ class ElfFile
 
     vector<SectionName> sectionsByOldIndex;
 
+    FileRanges changedRanges;
+
+    void markChanged(void * p, size_t size)
+    {
+        changedRanges.push_back(make_pair(
+            (off_t) ((unsigned char *) p - contents), size));
+    }
+
 public:
 
     ElfFile()
@@ -84,6 +106,18 @@ public:
         return changed;
     }
 
+    /* True if all the changes were made within the existing sections,
+       so that only the modified ranges need to be written back. */
+    bool isChangedInPlace()
+    {
+        return changed && replacedSections.empty();
+    }
+
+    const FileRanges & getChangedRanges()
+    {
+        return changedRanges;
+    }
+
     void parse();
 
 private:
@@ -207,8 +241,17 @@ static void debug(const char * format, ...)
 
 static void error(string msg)
 {
-    if (errno) perror(msg.c_str()); else fprintf(stderr, "%s\n", msg.c_str());
-    exit(1);
+    if (errno) msg += string(": ") + strerror(errno);
+    throw PatchelfError(msg);
+}
+
+
+static void printValue(const string & value)
+{
+    if (batchMode)
+        printf("%s: %s\n", fileName.c_str(), value.c_str());
+    else
+        printf("%s\n", value.c_str());
 }
 
 
@@ -230,15 +273,33 @@ static void readFile(string fileName, mode_t * fileMode)
     *fileMode = st.st_mode;
     maxSize = fileSize + 8 * 1024 * 1024;
 
-    contents = (unsigned char *) malloc(fileSize + maxSize);
-    if (!contents) abort();
+    /* Reserve room for growing the file and map the file privately
+       over the start of it.  Pages are only read in and copied when
+       they are touched, so a change that fits in place costs a few
+       pages instead of a copy of the whole file. */
+    void * p = mmap(0, maxSize, PROT_READ | PROT_WRITE,
+        MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+    if (p == MAP_FAILED) error("mmap");
+    contents = (unsigned char *) p;
+    mappedSize = maxSize;
+
+    if (fileSize == 0) return;
 
     int fd = open(fileName.c_str(), O_RDONLY);
     if (fd == -1) error("open");
 
-    if (read(fd, contents, fileSize) != fileSize) error("read");
-
+    p = mmap(contents, fileSize, PROT_READ | PROT_WRITE,
+        MAP_PRIVATE | MAP_FIXED, fd, 0);
     close(fd);
+    if (p == MAP_FAILED) error("mmap");
+}
+
+
+static void closeFile()
+{
+    if (contents) munmap(contents, mappedSize);
+    contents = 0;
+    fileSize = maxSize = mappedSize = 0;
 }
 
 
@@ -376,6 +437,31 @@ static void writeFile(string fileName, mode_t fileMode)
 }
 
 
+static void writeFileRanges(string fileName, mode_t fileMode,
+    const FileRanges & ranges)
+{
+    int fd = open(fileName.c_str(), O_WRONLY);
+    if (fd == -1) {
+        /* A running executable can't be opened for writing, but it
+           can be replaced. */
+        if (errno == ETXTBSY) {
+            errno = 0;
+            writeFile(fileName, fileMode);
+            return;
+        }
+        error("open");
+    }
+
+    for (FileRanges::const_iterator i = ranges.begin(); i != ranges.end(); ++i)
+        if (pwrite(fd, contents + i->first, i->second, i->first) != (ssize_t) i->second) {
+            close(fd);
+            error("write");
+        }
+
+    if (close(fd) != 0) error("close");
+}
+
+
 static unsigned int roundUp(unsigned int n, unsigned int m)
 {
     return ((n - 1) / m + 1) * m;
@@ -911,7 +997,7 @@ void ElfFile<ElfFileParamNames>::modifyRPath(RPathOp op, string newRPath)
        unless you use its `--enable-new-dtag' option, in which case it
        generates a DT_RPATH and DT_RUNPATH pointing at the same
        string. */
-    static vector<string> neededLibs;
+    vector<string> neededLibs;
     dyn = (Elf_Dyn *) (contents + rdi(shdrDynamic.sh_offset));
     Elf_Dyn * dynRPath = 0, * dynRunPath = 0;
     char * rpath = 0;
@@ -931,7 +1017,7 @@ void ElfFile<ElfFileParamNames>::modifyRPath(RPathOp op, string newRPath)
     }
 
     if (op == rpPrint) {
-        printf("%s\n", rpath ? rpath : "");
+        printValue(rpath ? rpath : "");
         return;
     }
 
@@ -944,7 +1030,7 @@ void ElfFile<ElfFileParamNames>::modifyRPath(RPathOp op, string newRPath)
     /* For each directory in the RPATH, check if it contains any
        needed library. */
     if (op == rpShrink) {
-        static vector<bool> neededLibFound(neededLibs.size(), false);
+        vector<bool> neededLibFound(neededLibs.size(), false);
 
         newRPath = "";
 
@@ -989,6 +1075,7 @@ void ElfFile<ElfFileParamNames>::modifyRPath(RPathOp op, string newRPath)
     if (string(rpath ? rpath : "") == newRPath) return;
 
     changed = true;
+    markChanged(contents + rdi(shdrDynamic.sh_offset), rdi(shdrDynamic.sh_size));
 
     /* Zero out the previous rpath to prevent retained dependencies in
        Nix. */
@@ -996,6 +1083,7 @@ void ElfFile<ElfFileParamNames>::modifyRPath(RPathOp op, string newRPath)
     if (rpath) {
         rpathSize = strlen(rpath);
         memset(rpath, 'X', rpathSize);
+        markChanged(rpath, rpathSize);
     }
 
     debug("new rpath is `%s'\n", newRPath.c_str());
@@ -1077,6 +1165,9 @@ void ElfFile<ElfFileParamNames>::removeNeeded(set<string> libs)
     }
 
     memset(last, 0, sizeof(Elf_Dyn) * (dyn - last));
+
+    if (changed)
+        markChanged(contents + rdi(shdrDynamic.sh_offset), rdi(shdrDynamic.sh_size));
 }
 
 
@@ -1096,7 +1187,7 @@ static void patchElf2(ElfFile & elfFile, mode_t fileMode)
     elfFile.parse();
 
     if (printInterpreter)
-        printf("%s\n", elfFile.getInterpreter().c_str());
+        printValue(elfFile.getInterpreter());
 
     if (newInterpreter != "")
         elfFile.setInterpreter(newInterpreter);
@@ -1111,7 +1202,9 @@ static void patchElf2(ElfFile & elfFile, mode_t fileMode)
 
     elfFile.removeNeeded(neededLibsToRemove);
 
-    if (elfFile.isChanged()){
+    if (elfFile.isChangedInPlace())
+        writeFileRanges(fileName, fileMode, elfFile.getChangedRanges());
+    else if (elfFile.isChanged()){
         elfFile.rewriteSections();
         writeFile(fileName, fileMode);
     }
@@ -1164,11 +1257,28 @@ void showHelp(const string & progName)
   [--remove-needed LIBRARY]\n\
   [--debug]\n\
   [--version]\n\
-  FILENAME\n", progName.c_str());
+  FILENAME...\n\
+\n\
+A FILENAME of - reads the names of the files to patch from stdin,\n\
+one per line.\n", progName.c_str());
 }
 
 
-int main(int argc, char * * argv)
+static void readFileNames(FILE * f, vector<string> & fileNames)
+{
+    char * line = 0;
+    size_t lineSize = 0;
+    ssize_t len;
+    while ((len = getline(&line, &lineSize, f)) != -1) {
+        while (len > 0 && (line[len - 1] == '\n' || line[len - 1] == '\r'))
+            line[--len] = 0;
+        if (len > 0) fileNames.push_back(string(line, len));
+    }
+    free(line);
+}
+
+
+static int mainWrapped(int argc, char * * argv)
 {
     if (argc <= 1) {
         showHelp(argv[0]);
@@ -1231,9 +1341,40 @@ int main(int argc, char * * argv)
     }
 
     if (i == argc) error("missing filename");
-    fileName = argv[i];
 
-    patchElf();
+    vector<string> fileNames;
+    for ( ; i < argc; ++i) {
+        if (string(argv[i]) == "-")
+            readFileNames(stdin, fileNames);
+        else
+            fileNames.push_back(argv[i]);
+    }
 
-    return 0;
+    batchMode = fileNames.size() > 1;
+
+    int status = 0;
+    for (vector<string>::iterator f = fileNames.begin(); f != fileNames.end(); ++f) {
+        fileName = *f;
+        errno = 0;
+        try {
+            patchElf();
+        } catch (PatchelfError & e) {
+            fprintf(stderr, "%s: %s\n", fileName.c_str(), e.msg.c_str());
+            status = 1;
+        }
+        closeFile();
+    }
+
+    return status;
+}
+
+
+int main(int argc, char * * argv)
+{
+    try {
+        return mainWrapped(argc, argv);
+    } catch (PatchelfError & e) {
+        fprintf(stderr, "%s\n", e.msg.c_str());
+        return 1;
+    }
 }
@@ -0,0 +1,94 @@
+import sys
+import threading
+import traceback
+
+from distutils import log
+from distutils.errors import DistutilsSetupError
+
+
+class TaskGraph(object):
+    """Runs named tasks in dependency order
+
+    Every task runs in its own thread as soon as all the tasks it depends
+    on have finished, so independent tasks run at the same time. After a
+    task fails no new tasks are started; the running ones are waited for
+    and the first error is raised again.
+    """
+    def __init__(self):
+        self.tasks = {}
+        self.order = []
+
+    def add(self, name, func, deps=None):
+        if name in self.tasks:
+            raise DistutilsSetupError("Task %s is defined twice" % name)
+        deps = list(deps or [])
+        for dep in deps:
+            if not dep in self.tasks:
+                raise DistutilsSetupError(
+                    "Task %s depends on the unknown task %s" % (name, dep))
+        self.tasks[name] = (func, deps)
+        self.order.append(name)
+
+    def names(self):
+        return list(self.order)
+
+    def run(self, max_workers=None):
+        pending = list(self.order)
+        running = set()
+        done = set()
+        finished = []
+        errors = []
+        cond = threading.Condition()
+
+        def worker(name, func):
+            error = None
+            try:
+                func()
+            except:
+                error = sys.exc_info()
+            cond.acquire()
+            try:
+                finished.append((name, error))
+                cond.notify()
+            finally:
+                cond.release()
+
+        while pending or running:
+            if not errors:
+                for name in list(pending):
+                    if max_workers and len(running) >= max_workers:
+                        break
+                    func, deps = self.tasks[name]
+                    if [dep for dep in deps if not dep in done]:
+                        continue
+                    pending.remove(name)
+                    running.add(name)
+                    log.info("Starting task %s..." % name)
+                    thread = threading.Thread(target=worker, args=(name, func))
+                    thread.daemon = True
+                    thread.start()
+            if not running:
+                # Either a task failed or nothing is runnable
+                break
+            cond.acquire()
+            try:
+                while not finished:
+                    cond.wait()
+                results = finished[:]
+                del finished[:]
+            finally:
+                cond.release()
+            for name, error in results:
+                running.remove(name)
+                if error is None:
+                    done.add(name)
+                else:
+                    log.error("Task %s failed:\n%s" % (name,
+                        "".join(traceback.format_exception(*error))))
+                    errors.append(error)
+        if errors:
+            raise errors[0][1]
+        if pending:
+            raise DistutilsSetupError(
+                "Tasks %s can not be run, their dependencies are not met" %
+                ", ".join(pending))
@@ -0,0 +1,160 @@
+"""Tests of the Mach-O and ELF code of shiboken_postinstall
+
+The fixtures in data/ are tiny binaries:
+
+- libthin.dylib: a x86_64 dylib header with hand-written load commands
+- libfat.dylib: a universal file with a x86_64 and a 32-bit big-endian
+  ppc slice, which load different libraries
+- librpath.so, librunpath.so: built with
+  ``gcc -shared -nostdlib -s -Wl,--build-id=none -Wl,-z,noseparate-code``
+  and ``-Wl,--disable-new-dtags -Wl,-rpath,/opt/qt/lib:/opt/python/lib``
+  or ``-Wl,--enable-new-dtags -Wl,-rpath,/opt/qt/lib``
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shiboken_postinstall import MachOFile
+from shiboken_postinstall import MachOError
+from shiboken_postinstall import get_localize_args
+from shiboken_postinstall import ElfFile
+from shiboken_postinstall import elf_set_rpath
+from shiboken_postinstall import DT_RPATH
+from shiboken_postinstall import DT_RUNPATH
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+def data_path(name):
+    return os.path.join(DATA_DIR, name)
+
+
+def read_bytes(path):
+    f = open(path, "rb")
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+class MachOTest(unittest.TestCase):
+
+    def test_thin(self):
+        macho = MachOFile(data_path("libthin.dylib"))
+        self.assertEqual(macho.install_names, [
+            "libshiboken-python2.7.1.2.dylib",
+            "libpython2.7.dylib",
+            "/usr/lib/libSystem.B.dylib",
+        ])
+        self.assertEqual(macho.rpaths, ["@loader_path/../lib"])
+
+    def test_fat_merges_the_architectures(self):
+        macho = MachOFile(data_path("libfat.dylib"))
+        self.assertEqual(macho.install_names, [
+            "libshiboken.1.2.dylib",
+            "QtCore.framework/Versions/4/QtCore",
+            "libweak.dylib",
+            "libppconly.dylib",
+        ])
+        self.assertEqual(macho.rpaths, ["@loader_path", "/opt/ppc/lib"])
+
+    def test_truncated(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "truncated.dylib")
+            f = open(path, "wb")
+            f.write(read_bytes(data_path("libthin.dylib"))[:100])
+            f.close()
+            self.assertRaises(MachOError, MachOFile, path)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_localize_args(self):
+        macho = MachOFile(data_path("libthin.dylib"))
+        self.assertEqual(get_localize_args(macho, "@loader_path"), [
+            "-change", "libshiboken-python2.7.1.2.dylib",
+            "@rpath/libshiboken-python2.7.1.2.dylib",
+            "-change", "libpython2.7.dylib", "@rpath/libpython2.7.dylib",
+            "-add_rpath", "@loader_path",
+        ])
+        # The rpath is only added when it is missing
+        self.assertEqual(get_localize_args(macho, "@loader_path/../lib"), [
+            "-change", "libshiboken-python2.7.1.2.dylib",
+            "@rpath/libshiboken-python2.7.1.2.dylib",
+            "-change", "libpython2.7.dylib", "@rpath/libpython2.7.dylib",
+        ])
+
+    def test_localize_args_fat(self):
+        macho = MachOFile(data_path("libfat.dylib"))
+        args = get_localize_args(macho, "@loader_path")
+        self.assertFalse("-add_rpath" in args)
+        self.assertEqual(args[-3:], ["-change", "libppconly.dylib",
+            "@rpath/libppconly.dylib"])
+
+
+class ElfRpathTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def copy(self, name):
+        path = os.path.join(self.tmp_dir, name)
+        shutil.copyfile(data_path(name), path)
+        return path
+
+    def get_tags(self, path):
+        elf = ElfFile(path)
+        try:
+            return (elf.get_rpath(), elf._get_dynamic_entry(DT_RUNPATH)
+                is not None, elf._get_dynamic_entry(DT_RPATH) is not None)
+        finally:
+            elf.close()
+
+    def test_read(self):
+        self.assertEqual(self.get_tags(data_path("librpath.so")),
+            ("/opt/qt/lib:/opt/python/lib", False, True))
+        self.assertEqual(self.get_tags(data_path("librunpath.so")),
+            ("/opt/qt/lib", True, False))
+
+    def test_shrink_converts_to_runpath(self):
+        path = self.copy("librpath.so")
+        self.assertTrue(elf_set_rpath(path, "$ORIGIN"))
+        self.assertEqual(self.get_tags(path), ("$ORIGIN", True, False))
+        # Same size, the rest of the old value is blanked out
+        old_data = read_bytes(data_path("librpath.so"))
+        new_data = read_bytes(path)
+        self.assertEqual(len(new_data), len(old_data))
+        start = old_data.index(b"/opt/qt/lib:/opt/python/lib\0")
+        self.assertEqual(new_data[start:start + 28],
+            b"$ORIGIN\0" + b"X" * 19 + b"\0")
+
+    def test_same_length(self):
+        path = self.copy("librunpath.so")
+        self.assertTrue(elf_set_rpath(path, "$ORIGIN/lib"))
+        self.assertEqual(self.get_tags(path), ("$ORIGIN/lib", True, False))
+
+    def test_unchanged(self):
+        path = self.copy("librunpath.so")
+        self.assertTrue(elf_set_rpath(path, "/opt/qt/lib"))
+        self.assertEqual(read_bytes(path), read_bytes(data_path("librunpath.so")))
+
+    def test_grow_is_left_to_patchelf(self):
+        path = self.copy("librunpath.so")
+        self.assertFalse(elf_set_rpath(path, "$ORIGIN:/a/much/longer/rpath"))
+        self.assertEqual(read_bytes(path), read_bytes(data_path("librunpath.so")))
+
+    def test_not_elf(self):
+        path = self.copy("libthin.dylib")
+        self.assertFalse(elf_set_rpath(path, "$ORIGIN"))
+        self.assertEqual(read_bytes(path), read_bytes(data_path("libthin.dylib")))
+
+
+if __name__ == "__main__":
+    unittest.main()
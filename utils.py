@@ -7,19 +7,39 @@ import shutil
 import subprocess
 import fnmatch
 import itertools
-import popenasync
+import threading
+import hashlib
+import json
+import multiprocessing
+import collections
+
+from multiprocessing.pool import ThreadPool
 
 from distutils import log
 from distutils.errors import DistutilsOptionError
 from distutils.errors import DistutilsSetupError
-from distutils.spawn import spawn
-from distutils.spawn import DistutilsExecError
+from distutils.spawn import find_executable
+
+from shiboken_postinstall import ElfFile
+from shiboken_postinstall import ElfError
 
 try:
     WindowsError
 except NameError:
     WindowsError = None
 
+# Seconds to wait for the remaining output of a finished process
+OUTPUT_DRAIN_TIMEOUT = 1.0
+
+# Number of output lines shown when a logged process fails
+ERROR_TAIL_LINES = 50
+
+# Write buffer size of the process log files
+LOG_BUFFER_SIZE = 64 * 1024
+
+# Maximum number of files copied in parallel by copydir()
+COPY_WORKERS = 8
+
 
 def has_option(name):
     try:
@@ -221,6 +241,114 @@ def init_msvc_env(platform_arch, build_type):
     log.info("Done initializing MSVC env")
 
 
+def get_cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def get_default_jobs():
+    """Return the number of parallel build jobs to use by default
+
+    Starts from the number of CPUs and leaves out the ones that are
+    already busy according to the one minute load average.
+    """
+    jobs = get_cpu_count()
+    try:
+        jobs -= int(os.getloadavg()[0])
+    except (AttributeError, OSError):
+        # No load average on this platform
+        pass
+    return max(1, jobs)
+
+
+def _scandir(path):
+    """Yield (name, is_dir, stat_func) for the entries in path
+
+    With os.scandir the stat results come from the directory listing
+    and are cached by the entries, so no extra system calls are needed.
+    """
+    if hasattr(os, "scandir"):
+        for entry in os.scandir(path):
+            yield entry.name, entry.is_dir(), entry.stat
+    else:
+        for name in os.listdir(path):
+            fullname = os.path.join(path, name)
+            yield name, os.path.isdir(fullname), \
+                lambda fullname=fullname: os.stat(fullname)
+
+
+def _is_up_to_date(src_stat, dst):
+    try:
+        dst_stat = os.stat(dst)
+    except OSError:
+        return False
+    # copystat() preserves mtime, so a previously copied file has the
+    # same size and (within the filesystem's precision) modification time
+    return stat.S_ISREG(dst_stat.st_mode) and \
+        dst_stat.st_size == src_stat.st_size and \
+        abs(dst_stat.st_mtime - src_stat.st_mtime) < 0.001
+
+
+def _kernel_copy(fsrc, fdst, size):
+    infd = fsrc.fileno()
+    outfd = fdst.fileno()
+    offset = 0
+    while offset < size:
+        if hasattr(os, "copy_file_range"):
+            # May share the data blocks (reflink) on filesystems like btrfs
+            sent = os.copy_file_range(infd, outfd, size - offset)
+        else:
+            sent = os.sendfile(outfd, infd, offset, size - offset)
+        if sent == 0:
+            break
+        offset += sent
+    return offset
+
+
+def _copy_file_data(src, dst):
+    fsrc = open(src, "rb")
+    try:
+        fdst = open(dst, "wb")
+        try:
+            if sys.platform.startswith("linux") and \
+                (hasattr(os, "copy_file_range") or hasattr(os, "sendfile")):
+                size = os.fstat(fsrc.fileno()).st_size
+                try:
+                    _kernel_copy(fsrc, fdst, size)
+                    return
+                except OSError as why:
+                    if why.errno not in (errno.ENOSYS, errno.EXDEV,
+                        errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP):
+                        raise
+                    # Not supported for these files, do a regular copy
+                    fsrc.seek(0)
+                    fdst.seek(0)
+                    fdst.truncate()
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+        finally:
+            fdst.close()
+    finally:
+        fsrc.close()
+
+
+def _copy_file(src, dst, src_stat=None):
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if src_stat is None:
+        src_stat = os.stat(src)
+    
+    if _is_up_to_date(src_stat, dst):
+        log.info("Skipping copy file %s to %s. Destination is up to date." % (src, dst))
+        return
+    
+    log.info("Copying file %s to %s." % (src, dst))
+    
+    _copy_file_data(src, dst)
+    shutil.copystat(src, dst)
+
+
 def copyfile(src, dst, force=True, vars=None):
     if vars is not None:
         src = src.format(**vars)
@@ -230,9 +358,55 @@ def copyfile(src, dst, force=True, vars=None):
         log.info("**Skiping copy file %s to %s. Source does not exists." % (src, dst))
         return
     
-    log.info("Copying file %s to %s." % (src, dst))
-    
-    shutil.copy2(src, dst)
+    _copy_file(src, dst)
+
+
+def get_needed_closure(binaries, lib_dirs):
+    """Return the libraries from `lib_dirs` that `binaries` load, directly
+    or through each other, as a sorted list of (needed name, path).
+
+    Follows the ELF DT_NEEDED entries. Libraries that are not found in
+    `lib_dirs`, like the system ones, are left out.
+    """
+    found = {}
+    pending = list(binaries)
+    seen = set()
+    while pending:
+        path = pending.pop()
+        if path in seen:
+            continue
+        seen.add(path)
+        try:
+            elf = ElfFile(path)
+            try:
+                needed = elf.get_needed()
+            finally:
+                elf.close()
+        except ElfError as e:
+            raise DistutilsSetupError("Can not read the dependencies: %s" % e)
+        for name in needed:
+            if name in found:
+                continue
+            for lib_dir in lib_dirs:
+                lib_path = os.path.join(lib_dir, name)
+                if os.path.isfile(lib_path):
+                    log.info("%s needs %s" % (os.path.basename(path), lib_path))
+                    found[name] = lib_path
+                    pending.append(lib_path)
+                    break
+    return sorted(found.items())
+
+
+def get_elf_build_id(path):
+    """Return the GNU build id of an ELF file as a hex string, or None"""
+    try:
+        elf = ElfFile(path)
+        try:
+            return elf.get_build_id()
+        finally:
+            elf.close()
+    except ElfError:
+        return None
 
 
 def makefile(dst, content=None, vars=None):
@@ -274,39 +448,72 @@ def copydir(src, dst, filter=None, ignore=None, force=True,
     log.info("Copying tree %s to %s. filter=%s. ignore=%s." % \
         (src, dst, filter, ignore))
     
-    names = os.listdir(src)
-    
+    files = []
+    dirs = []
     errors = []
-    for name in names:
+    _scan_tree(src, dst, filter, ignore, recursive, files, dirs, errors)
+    errors.extend(_copy_files(files))
+    # Copying the files updates the directory times, so set them last,
+    # deepest directories first
+    for srcdir, dstdir in reversed(dirs):
+        try:
+            shutil.copystat(srcdir, dstdir)
+        except OSError as why:
+            if WindowsError is not None and isinstance(why, WindowsError):
+                # Copying file access times may fail on Windows
+                pass
+            else:
+                errors.extend((srcdir, dstdir, str(why)))
+    if errors:
+        raise EnvironmentError(errors)
+
+
+def _scan_tree(src, dst, filter, ignore, recursive, files, dirs, errors):
+    dirs.append((src, dst))
+    for name, is_dir, get_stat in _scandir(src):
         srcname = os.path.join(src, name)
         dstname = os.path.join(dst, name)
         try:
-            if os.path.isdir(srcname):
+            if is_dir:
                 if recursive:
-                    copydir(srcname, dstname, filter, ignore, force, recursive, vars)
+                    _scan_tree(srcname, dstname, filter, ignore, recursive,
+                        files, dirs, errors)
             else:
                 if (filter is not None and not filter_match(name, filter)) or \
                     (ignore is not None and filter_match(name, ignore)):
                     continue
                 if not os.path.exists(dst):
                     os.makedirs(dst)
-                copyfile(srcname, dstname, True, vars)
-        # catch the Error from the recursive copytree so that we can
-        # continue with other files
-        except shutil.Error as err:
-            errors.extend(err.args[0])
+                files.append((srcname, dstname, get_stat()))
         except EnvironmentError as why:
             errors.append((srcname, dstname, str(why)))
+
+
+def _copy_file_job(job):
+    srcname, dstname, src_stat = job
     try:
-        shutil.copystat(src, dst)
-    except OSError as why:
-        if WindowsError is not None and isinstance(why, WindowsError):
-            # Copying file access times may fail on Windows
-            pass
-        else:
-            errors.extend((src, dst, str(why)))
-    if errors:
-        raise EnvironmentError(errors)
+        _copy_file(srcname, dstname, src_stat)
+    except EnvironmentError as why:
+        return (srcname, dstname, str(why))
+    return None
+
+
+def _copy_files(files):
+    """Copy the (src, dst, src_stat) list on a bounded thread pool
+
+    Returns the list of errors.
+    """
+    workers = min(COPY_WORKERS, len(files))
+    if workers <= 1:
+        results = [_copy_file_job(job) for job in files]
+    else:
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(_copy_file_job, files)
+        finally:
+            pool.close()
+            pool.join()
+    return [error for error in results if error is not None]
 
 
 def rmtree(dirname):
@@ -320,31 +527,79 @@ def rmtree(dirname):
     shutil.rmtree(dirname, ignore_errors=False, onerror=handleRemoveReadonly)
 
 
-def run_process(args, initial_env=None):
-    def _log(buffer, checkNewLine=False):
-        endsWithNewLine = False
-        if buffer.endswith('\n'):
-            endsWithNewLine = True
-        if checkNewLine and buffer.find('\n') == -1:
-            return buffer
-        lines = buffer.splitlines()
-        buffer = ''
-        if checkNewLine and not endsWithNewLine:
-            buffer = lines[-1]
-            lines = lines[:-1]
-        for line in lines:
-            log.info(line.rstrip('\r'))
-        return buffer
-    
-    _log("Running process: {0}".format(" ".join([(" " in x and '"{0}"'.format(x) or x) for x in args])))
-    
-    if sys.platform != "win32":
+class ProcessOutput(object):
+    """Receives the output lines of a process
+
+    With a log file the lines are only written to it, through a large
+    buffer, otherwise they are logged as they arrive. Either way the last
+    lines are kept in a bounded buffer for the error report. The lines are
+    also passed to the add_line() method of the optional progress object.
+    """
+    def __init__(self, log_path=None, tail_lines=ERROR_TAIL_LINES,
+        progress=None):
+        self.log_path = log_path
+        self.progress = progress
+        self.log_file = None
+        if log_path:
+            self.log_file = open(log_path, "ab", LOG_BUFFER_SIZE)
+        self.tail = collections.deque(maxlen=tail_lines)
+        self.lock = threading.Lock()
+
+    def write_header(self, text):
+        if self.log_file is not None:
+            self.log_file.write(("$ %s\n" % text).encode("utf-8"))
+
+    def add_line(self, line):
+        self.lock.acquire()
         try:
-            spawn(args)
-            return 0
-        except DistutilsExecError:
-            return -1
+            if self.log_file is not None:
+                self.log_file.write(line)
+            self.tail.append(line)
+        finally:
+            self.lock.release()
+        if not self.log_path:
+            log.info(self.decode(line))
+        if self.progress is not None:
+            self.progress.add_line(line)
+
+    def get_tail(self):
+        self.lock.acquire()
+        try:
+            return [self.decode(line) for line in self.tail]
+        finally:
+            self.lock.release()
+
+    def decode(self, line):
+        return line.decode("utf-8", "replace").rstrip("\r\n")
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.log_file is not None:
+                self.log_file.close()
+                self.log_file = None
+        finally:
+            self.lock.release()
+
+
+def _read_output(stream, output):
+    # readline() blocks until the child writes a full line or closes the
+    # pipe, so every line is handled as soon as it arrives.
+    for line in iter(stream.readline, b''):
+        output.add_line(line)
+
 
+def run_process(args, initial_env=None, cwd=None, log_path=None,
+    progress=None, monitor=None):
+    """Run a command and return its exit code
+
+    The output goes to log_path when given, and only the last lines of it
+    are shown when the command fails. The progress object gets every line
+    of the output, the monitor the pid of the command while it runs.
+    """
+    cmd_line = " ".join([(" " in x and '"{0}"'.format(x) or x) for x in args])
+    log.info("Running process: {0}".format(cmd_line))
+    
     shell = False
     if sys.platform == "win32":
         shell = True
@@ -352,24 +607,238 @@ def run_process(args, initial_env=None):
     if initial_env is None:
         initial_env = os.environ
     
-    proc = popenasync.Popen(args,
-        stdin = subprocess.PIPE,
-        stdout = subprocess.PIPE, 
-        stderr = subprocess.STDOUT,
-        universal_newlines = 1,
-        shell = shell,
-        env = initial_env)
-    
-    log_buffer = None;
-    while proc.poll() is None:
-        log_buffer = _log(proc.read_async(wait=0.1, e=0))
-    if log_buffer:
-        _log(log_buffer)
-    
-    proc.wait()
+    output = ProcessOutput(log_path, progress=progress)
+    try:
+        output.write_header(cmd_line)
+        if log_path:
+            log.info("Writing the output to %s" % log_path)
+        try:
+            proc = subprocess.Popen(args,
+                stdout = subprocess.PIPE, 
+                stderr = subprocess.STDOUT,
+                shell = shell,
+                env = initial_env,
+                cwd = cwd)
+        except OSError:
+            log.error("Failed to run %s: %s" % (args[0], sys.exc_info()[1]))
+            return -1
+        
+        if monitor is not None:
+            monitor.add_process(proc.pid)
+        reader = threading.Thread(target=_read_output, args=(proc.stdout, output))
+        reader.daemon = True
+        reader.start()
+        try:
+            proc.wait()
+        finally:
+            if monitor is not None:
+                monitor.remove_process(proc.pid)
+        # The pipe can outlive the child when a grandchild inherited it
+        # (e.g. mspdbsrv.exe), so only wait a moment for the remaining output.
+        reader.join(OUTPUT_DRAIN_TIMEOUT)
+    finally:
+        output.close()
+    if proc.returncode != 0 and log_path:
+        tail = output.get_tail()
+        log.error("Process failed with exit code %s, last %d lines of %s:\n%s" %
+            (proc.returncode, len(tail), log_path, "\n".join(tail)))
     return proc.returncode
 
 
+def fingerprint(values):
+    """Return a stable hash of a json serializable list of values"""
+    data = json.dumps(values, sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def read_fingerprint(path):
+    try:
+        f = open(path, "r")
+        try:
+            return f.read().strip()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return None
+
+
+def write_fingerprint(path, value):
+    f = open(path, "w")
+    try:
+        f.write(value)
+    finally:
+        f.close()
+
+
+def read_json_file(path):
+    """Return the content of a json file, or None if it can't be read"""
+    try:
+        f = open(path, "r")
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_json_file(path, data):
+    """Write a json file atomically, so concurrent builds never read it
+    half written"""
+    dir = os.path.dirname(path)
+    if dir and not os.path.exists(dir):
+        os.makedirs(dir)
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    f = open(tmp_path, "w")
+    try:
+        json.dump(data, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+    if sys.platform == "win32" and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+def get_file_identity(path):
+    """Return (path, size, mtime) describing the given file, or None"""
+    if not path:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [os.path.abspath(path), st.st_size, st.st_mtime]
+
+
+def get_compiler_identity():
+    """Identify the C++ compiler cmake is going to pick up
+
+    Honors the CXX environment variable the same way cmake does and
+    falls back to the default compiler names.
+    """
+    compiler = os.environ.get("CXX")
+    if compiler:
+        compiler_path = find_executable(compiler) or compiler
+    else:
+        compiler_path = None
+        for name in ["c++", "g++", "clang++", "cl"]:
+            compiler_path = find_executable(name)
+            if compiler_path:
+                break
+    if compiler_path:
+        # Resolve the alternatives and ccache style symlinks
+        compiler_path = os.path.realpath(compiler_path)
+    return [compiler, get_file_identity(compiler_path)]
+
+
+def find_compiler_cache(name=None):
+    """Find the compiler cache to use as the compiler launcher
+
+    `name` is "ccache", "sccache", a path to one of them or "none".
+    When it is not given, ccache and then sccache are looked up in PATH.
+    Returns a (kind, path) tuple, or None when no cache should be used.
+    """
+    if name and name.lower() == "none":
+        return None
+    if name:
+        path = find_executable(name) or name
+        if not os.path.exists(path):
+            raise DistutilsSetupError(
+                "Failed to find the compiler cache %s." % name)
+        kind = "ccache"
+        if "sccache" in os.path.basename(path).lower():
+            kind = "sccache"
+        return kind, path
+    for kind in ["ccache", "sccache"]:
+        path = find_executable(kind)
+        if path:
+            return kind, path
+    return None
+
+
+def init_compiler_cache_env(compiler_cache, cache_dir=None, base_dir=None):
+    kind, path = compiler_cache
+    if cache_dir:
+        cache_dir = os.path.abspath(cache_dir)
+        log.info("Using compiler cache directory %s" % cache_dir)
+        if kind == "sccache":
+            os.environ["SCCACHE_DIR"] = cache_dir
+        else:
+            os.environ["CCACHE_DIR"] = cache_dir
+    if kind == "ccache" and base_dir and not "CCACHE_BASEDIR" in os.environ:
+        # Hash the paths relative to the setup directory, so that the
+        # per build_name build trees can share the cached objects
+        os.environ["CCACHE_BASEDIR"] = base_dir
+
+
+def get_compiler_cache_stats(compiler_cache):
+    """Return the (hits, misses) counters of the compiler cache
+
+    Returns None when the statistics can not be read.
+    """
+    kind, path = compiler_cache
+    if kind == "sccache":
+        cmd = [path, "--show-stats", "--stats-format=json"]
+    else:
+        # Machine readable output is available since ccache 3.7
+        cmd = [path, "--print-stats"]
+    output = get_process_output(cmd)
+    if output is None:
+        return None
+    try:
+        if kind == "sccache":
+            stats = json.loads(output)["stats"]
+            hits = sum(stats["cache_hits"]["counts"].values())
+            misses = sum(stats["cache_misses"]["counts"].values())
+            return hits, misses
+        counters = {}
+        for line in output.splitlines():
+            fields = line.split("\t")
+            if len(fields) == 2:
+                counters[fields[0]] = int(fields[1])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+    # The counter names changed in ccache 4.0
+    hit_names = ["direct_cache_hit", "preprocessed_cache_hit",
+        "cache_hit_direct", "cache_hit_preprocessed"]
+    hits = sum([counters.get(n, 0) for n in hit_names])
+    misses = counters.get("cache_miss", 0)
+    return hits, misses
+
+
+def get_process_output(args, cwd=None):
+    """Run a command quietly and return its stripped output, or None on failure"""
+    try:
+        proc = subprocess.Popen(args, cwd=cwd,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        return None
+    if sys.version_info[0] > 2:
+        output = output.decode("utf-8", "replace")
+    return output.strip()
+
+
+def git_output(args, cwd=None):
+    return get_process_output(["git"] + args, cwd=cwd)
+
+
+def hash_file(path):
+    h = hashlib.sha1()
+    f = open(path, "rb")
+    try:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            h.update(data)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
 def get_environment_from_batch_command(env_cmd, initial=None):
     """
     Take a command (either a single command or list of arguments)
@@ -0,0 +1,287 @@
+import os
+import re
+import sys
+import time
+import zlib
+import base64
+import struct
+import fnmatch
+import hashlib
+import binascii
+
+from multiprocessing.pool import ThreadPool
+
+from distutils import log
+from distutils.errors import DistutilsOptionError
+from distutils.errors import DistutilsSetupError
+from distutils.sysconfig import get_config_var
+from distutils.util import get_platform
+
+from utils import get_cpu_count
+
+# Compression level of the files matched by no rule
+DEFAULT_COMPRESS_LEVEL = 6
+
+# Files that are compressed already are stored as they are
+DEFAULT_COMPRESS_RULES = [
+    ("*.gz", 0),
+    ("*.bz2", 0),
+    ("*.xz", 0),
+    ("*.zip", 0),
+    ("*.whl", 0),
+    ("*.egg", 0),
+    ("*.png", 0),
+    ("*.jpg", 0),
+    ("*.jpeg", 0),
+    ("*.gif", 0),
+]
+
+# Zip entries can't be older than 1980
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP_VERSION = 20
+ZIP_MAX = 0xffffffff
+ZIP_MAX_ENTRIES = 0xffff
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+END_RECORD = struct.Struct("<IHHHHIIH")
+
+
+def parse_compress_rules(value):
+    """Parse "PATTERN:LEVEL,..." into (default level, rules)
+
+    The pattern "*" sets the default level. Level 0 stores the files
+    uncompressed.
+    """
+    default_level = DEFAULT_COMPRESS_LEVEL
+    rules = []
+    if value:
+        for item in value.split(","):
+            pattern, sep, level = item.strip().rpartition(":")
+            try:
+                level = int(level)
+            except ValueError:
+                level = -1
+            if not sep or not pattern or not 0 <= level <= 9:
+                raise DistutilsOptionError(
+                    "Invalid wheel compression rule %s, expected "
+                    "PATTERN:LEVEL with a level from 0 to 9" % item)
+            if pattern == "*":
+                default_level = level
+            else:
+                rules.append((pattern, level))
+    return default_level, rules + DEFAULT_COMPRESS_RULES
+
+
+def get_date_time():
+    """Return the time stamp of all the wheel entries
+
+    Uses SOURCE_DATE_EPOCH when it is set, so that rebuilding the same
+    sources gives the same wheel, and the zip epoch otherwise.
+    """
+    epoch = os.environ.get("SOURCE_DATE_EPOCH")
+    if not epoch:
+        return ZIP_EPOCH
+    date_time = time.gmtime(int(epoch))[:6]
+    return max(date_time, ZIP_EPOCH)
+
+
+def get_python_tag():
+    return "cp%d%d" % sys.version_info[:2]
+
+
+def get_abi_tag():
+    soabi = get_config_var("SOABI")
+    if soabi and soabi.startswith("cpython-"):
+        # cpython-37m-x86_64-linux-gnu -> cp37m
+        return "cp" + soabi.split("-")[1]
+    # Python 2 and Windows have no SOABI
+    flags = ""
+    if get_config_var("Py_DEBUG") or hasattr(sys, "gettotalrefcount"):
+        flags += "d"
+    if sys.version_info < (3, 8) and get_config_var("WITH_PYMALLOC"):
+        flags += "m"
+    if sys.version_info[0] == 2 and sys.maxunicode == 0x10ffff:
+        flags += "u"
+    return get_python_tag() + flags
+
+
+def get_platform_tag():
+    return get_platform().replace("-", "_").replace(".", "_")
+
+
+def escape_name(name):
+    return re.sub(r"[^\w\d.]+", "_", name)
+
+
+def get_wheel_name(metadata):
+    return "%s-%s-%s-%s-%s.whl" % (escape_name(metadata.get_name()),
+        escape_name(metadata.get_version()), get_python_tag(),
+        get_abi_tag(), get_platform_tag())
+
+
+def get_metadata_content(metadata):
+    lines = [
+        "Metadata-Version: 2.1",
+        "Name: %s" % metadata.get_name(),
+        "Version: %s" % metadata.get_version(),
+        "Summary: %s" % metadata.get_description(),
+        "Home-page: %s" % metadata.get_url(),
+        "Author: %s" % metadata.get_author(),
+        "Author-email: %s" % metadata.get_author_email(),
+        "License: %s" % metadata.get_license(),
+    ]
+    keywords = metadata.get_keywords()
+    if keywords:
+        lines.append("Keywords: %s" % ",".join(keywords))
+    for classifier in metadata.get_classifiers():
+        lines.append("Classifier: %s" % classifier)
+    lines.append("Description-Content-Type: text/x-rst")
+    lines.append("")
+    lines.append(metadata.get_long_description() or "")
+    return "\n".join(lines)
+
+
+def get_wheel_content(generator, tag):
+    return "\n".join([
+        "Wheel-Version: 1.0",
+        "Generator: %s" % generator,
+        "Root-Is-Purelib: false",
+        "Tag: %s" % tag,
+        "",
+    ])
+
+
+class WheelWriter(object):
+    """Writes a wheel with reproducible contents
+
+    The entries are sorted, with the .dist-info folder last and RECORD as
+    the very last entry, and all of them get the same time stamp and
+    normalized permissions. The files are read and compressed on a thread
+    pool (zlib releases the GIL) and written in order as they become ready.
+    """
+    def __init__(self, path, dist_info_dir, default_level=DEFAULT_COMPRESS_LEVEL,
+        compress_rules=None, date_time=None, workers=None):
+        self.path = path
+        self.dist_info_dir = dist_info_dir
+        self.default_level = default_level
+        self.compress_rules = compress_rules or DEFAULT_COMPRESS_RULES
+        self.date_time = date_time or get_date_time()
+        self.workers = workers or get_cpu_count()
+        self.entries = {}
+
+    def add_file(self, arcname, path):
+        mode = 0o644
+        if os.stat(path).st_mode & 0o111:
+            mode = 0o755
+        self._add(arcname, path, None, mode)
+
+    def add_data(self, arcname, data, mode=0o644):
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        self._add(arcname, None, data, mode)
+
+    def _add(self, arcname, path, data, mode):
+        if arcname in self.entries:
+            raise DistutilsSetupError("Duplicate wheel entry %s" % arcname)
+        self.entries[arcname] = (path, data, mode)
+
+    def get_compress_level(self, arcname):
+        name = arcname.rsplit("/", 1)[-1]
+        for pattern, level in self.compress_rules:
+            if fnmatch.fnmatch(name, pattern):
+                return level
+        return self.default_level
+
+    def _sort_key(self, arcname):
+        return (arcname.startswith(self.dist_info_dir + "/"), arcname)
+
+    def _compress(self, arcname):
+        path, data, mode = self.entries[arcname]
+        if path is not None:
+            f = open(path, "rb")
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        level = self.get_compress_level(arcname)
+        if level:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            compressed = compressor.compress(data) + compressor.flush()
+            method = ZIP_DEFLATED
+        else:
+            compressed = data
+            method = ZIP_STORED
+        digest = base64.urlsafe_b64encode(
+            hashlib.sha256(data).digest()).rstrip(b"=").decode("ascii")
+        return (arcname, mode, method, binascii.crc32(data) & 0xffffffff,
+            len(data), compressed, "sha256=" + digest)
+
+    def close(self):
+        record_name = self.dist_info_dir + "/RECORD"
+        names = sorted(self.entries.keys(), key=self._sort_key)
+        log.info("Writing %s (%d entries)..." % (self.path, len(names) + 1))
+        records = []
+        tmp_path = "%s.%s.tmp" % (self.path, os.getpid())
+        f = open(tmp_path, "wb")
+        try:
+            central = []
+            pool = ThreadPool(max(1, min(self.workers, len(names))))
+            try:
+                for entry in pool.imap(self._compress, names):
+                    central.append(self._write_entry(f, entry))
+                    records.append("%s,%s,%d" % (entry[0], entry[6], entry[4]))
+            finally:
+                pool.close()
+                pool.join()
+            records.append("%s,," % record_name)
+            self.add_data(record_name, "\n".join(records) + "\n")
+            central.append(self._write_entry(f, self._compress(record_name)))
+            self._write_central_directory(f, central)
+        finally:
+            f.close()
+        if sys.platform == "win32" and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp_path, self.path)
+
+    def _get_dos_date_time(self):
+        year, month, day, hour, minute, second = self.date_time
+        return ((hour << 11) | (minute << 5) | (second // 2),
+            ((year - 1980) << 9) | (month << 5) | day)
+
+    def _write_entry(self, f, entry):
+        arcname, mode, method, crc, size, compressed, digest = entry
+        name = arcname.encode("utf-8")
+        offset = f.tell()
+        if offset > ZIP_MAX or size > ZIP_MAX:
+            raise DistutilsSetupError("%s is too big for a wheel without "
+                "zip64 extensions" % arcname)
+        # Bit 11: the name is utf-8
+        flags = 0x800
+        dos_time, dos_date = self._get_dos_date_time()
+        f.write(LOCAL_HEADER.pack(0x04034b50, ZIP_VERSION, flags, method,
+            dos_time, dos_date, crc, len(compressed), size, len(name), 0))
+        f.write(name)
+        f.write(compressed)
+        external_attr = (0o100000 | mode) << 16
+        return CENTRAL_HEADER.pack(0x02014b50, (3 << 8) | ZIP_VERSION,
+            ZIP_VERSION, flags, method, dos_time, dos_date, crc,
+            len(compressed), size, len(name), 0, 0, 0, 0, external_attr,
+            offset) + name
+
+    def _write_central_directory(self, f, central):
+        if len(central) > ZIP_MAX_ENTRIES:
+            raise DistutilsSetupError("Too many entries for a wheel without "
+                "zip64 extensions")
+        offset = f.tell()
+        for header in central:
+            f.write(header)
+        size = f.tell() - offset
+        if offset > ZIP_MAX:
+            raise DistutilsSetupError("The wheel is too big without zip64 "
+                "extensions")
+        f.write(END_RECORD.pack(0x06054b50, 0, 0, len(central),
+            len(central), size, offset, 0))